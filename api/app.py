@@ -1,8 +1,18 @@
 import datetime
+from functools import partial
 
+import click
 from bson.errors import InvalidId
 from bson.objectid import ObjectId
-from flask import Flask, jsonify, request
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    jsonify,
+    request,
+    send_file,
+    stream_with_context,
+)
 from flask_bcrypt import Bcrypt, generate_password_hash
 from flask_cors import CORS
 from flask_jwt_extended import (
@@ -11,39 +21,81 @@ from flask_jwt_extended import (
     get_jwt_identity,
     jwt_required,
 )
+from werkzeug.local import LocalProxy
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from api import config
+from api.encoders import OrjsonEncoder, stream_json_list
+from api.events import (
+    SUBSCRIBE_RETRY_SECONDS,
+    TooManySubscribers,
+    get_photo_event_broker,
+    stream_photo_events,
+)
+from api.files import get_file_backend
+from api.idempotency import idempotent
+from api.images import get_image_metadata
+from api.migrations import MIGRATIONS, MigrationRunner
 from api.models import Comment, Like, Photo, User
-from api.s3 import get_s3_uri
-from api.store import CommentStore, LikeStore, PhotoStore, UserStore, mongo_db
-
-
-def create_app():
-    app = Flask(__name__)
-    app.secret_key = config.secret_key
-    app.url_map.strict_slashes = False
-    app.config["SERVER_NAME"] = config.server_name
-    app.config["JWT_SECRET_KEY"] = config.jwt_secret_key
-    return app
-
-
-flask_app = create_app()
-bcrypt = Bcrypt(flask_app)
-jwt = JWTManager(flask_app)
-CORS(flask_app)
+from api.ratelimit import concurrency_limiter, rate_limiter
+from api.s3 import get_content_hash, get_s3_uri
+from api.similarity import get_photo_similarity_index
+from api.store import (
+    CommentStore,
+    LikeBucketStore,
+    LikeStore,
+    MigrationStore,
+    PhotoStore,
+    UserStore,
+    ensure_indexes,
+    get_mongo_db,
+    get_store,
+)
 
-user_store = UserStore(mongo_db)
-photo_store = PhotoStore(mongo_db)
-like_store = LikeStore(mongo_db)
-comment_store = CommentStore(mongo_db)
+routes = Blueprint("photoview", __name__, cli_group=None)
+bcrypt = Bcrypt()
+jwt = JWTManager()
+cors = CORS()
+
+# Stores and their Mongo client are built on first use in each worker process,
+# so importing the app and forking workers never opens a connection.
+user_store = LocalProxy(partial(get_store, UserStore))
+photo_store = LocalProxy(partial(get_store, PhotoStore))
+like_store = LocalProxy(
+    lambda: get_store(LikeBucketStore if config.like_storage == "bucket" else LikeStore)
+)
+comment_store = LocalProxy(partial(get_store, CommentStore))
 
 
-@flask_app.route("/health", methods=["GET"])
+@routes.route("/health", methods=["GET"])
 def health():
     return jsonify({"message": "healthy"})
 
 
-@flask_app.route("/signup", methods=["POST"])
+@routes.route("/files/<path:key>", methods=["GET"])
+def serve_file(key):
+    file_backend = get_file_backend()
+    path = file_backend.get_path(key)
+    if path is None:
+        return jsonify({"detail": "not found"}), 404
+
+    # keys are content addressed, a file never changes once stored
+    try:
+        response = send_file(path, conditional=True, max_age=config.file_max_age)
+    except FileNotFoundError:
+        # evicted from the cache by another worker since it was looked up
+        path = file_backend.get_path(key)
+        if path is None:
+            return jsonify({"detail": "not found"}), 404
+        response = send_file(path, conditional=True, max_age=config.file_max_age)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@routes.route("/signup", methods=["POST"])
+@rate_limiter.limit("auth", config.rate_limit_auth)
+@concurrency_limiter.limit
 def signup():
     json_data = request.get_json(force=True)
     name = json_data.get("name")
@@ -65,7 +117,9 @@ def signup():
     return jsonify({"message": "success", "body": {"user_id": str(user._id)}}), 201
 
 
-@flask_app.route("/signin", methods=["POST"])
+@routes.route("/signin", methods=["POST"])
+@rate_limiter.limit("auth", config.rate_limit_auth)
+@concurrency_limiter.limit
 def signin():
     body = request.get_json()
     email = body.get("email")
@@ -84,8 +138,11 @@ def signin():
     return {"token": access_token}, 200
 
 
-@flask_app.route("/photos", methods=["POST"])
+@routes.route("/photos", methods=["POST"])
 @jwt_required()
+@rate_limiter.limit("write", config.rate_limit_write)
+@idempotent
+@concurrency_limiter.limit
 def add_photo():
     photo_file = request.files["file"]
     if photo_file.filename == "":
@@ -97,21 +154,35 @@ def add_photo():
     if not user or not user.admin:
         return jsonify({"detail": "not found"}), 403
 
-    s3_uri = get_s3_uri(photo_file)
+    content_hash = get_content_hash(photo_file)
+    photo = photo_store.get_by_content_hash(content_hash)
+    if photo:
+        return jsonify({"message": "success", "body": {"photo_id": str(photo._id)}})
+
+    metadata = get_image_metadata(photo_file)
+    s3_uri = get_s3_uri(photo_file, content_hash)
 
     photo = Photo(
         {
             "_id": ObjectId(),
             "user_id": user_id,
             "URI": s3_uri,
+            "content_hash": content_hash,
+            **metadata,
         }
     )
-    photo_store.save(photo)
-
-    return jsonify({"message": "success", "body": {"photo_id": str(photo._id)}}), 201
+    photo, created = photo_store.get_or_save(photo)
+    status_code = 201 if created else 200
+    if created and photo.perceptual_hash:
+        get_photo_similarity_index().add(photo._id, photo.perceptual_hash)
+
+    return (
+        jsonify({"message": "success", "body": {"photo_id": str(photo._id)}}),
+        status_code,
+    )
 
 
-@flask_app.route("/photos", methods=["GET"])
+@routes.route("/photos", methods=["GET"])
 @jwt_required()
 def list_photos():
     offset = request.args.get("offset", 0)
@@ -131,7 +202,41 @@ def list_photos():
     )
 
 
-@flask_app.route("/photos/pendent", methods=["GET"])
+@routes.route("/photos/trending", methods=["GET"])
+@jwt_required()
+def list_trending_photos():
+    after = request.args.get("after")
+
+    try:
+        per_page = max(1, min(int(request.args.get("per_page", 10)), 100))
+        photos, next_cursor = photo_store.get_trending_photos(
+            after=after, per_page=per_page
+        )
+    except (ValueError, InvalidId):
+        return jsonify({"detail": "invalid per_page or cursor"}), 400
+
+    return jsonify({"photos": photos, "next": next_cursor, "per_page": per_page})
+
+
+@routes.route("/users/<string:user_id>/photos", methods=["GET"])
+@jwt_required()
+def list_user_photos(user_id):
+    after = request.args.get("after")
+    # owners also see their hidden photos and whether each is visible
+    include_hidden = get_jwt_identity() == user_id
+
+    try:
+        per_page = max(1, min(int(request.args.get("per_page", 10)), 100))
+        photos, next_cursor = photo_store.get_user_photos(
+            user_id, include_hidden=include_hidden, after=after, per_page=per_page
+        )
+    except (ValueError, InvalidId):
+        return jsonify({"detail": "invalid user_id, per_page or cursor"}), 400
+
+    return jsonify({"photos": photos, "next": next_cursor, "per_page": per_page})
+
+
+@routes.route("/photos/pendent", methods=["GET"])
 @jwt_required()
 def list_pendent_photos():
     user_id = get_jwt_identity()
@@ -142,16 +247,84 @@ def list_pendent_photos():
     if not user.admin:
         return jsonify({"detail": "forbidden"}), 403
 
-    photos = photo_store.get_pendent_photos()
+    similarity_index = get_photo_similarity_index()
 
-    return jsonify(
-        {
-            "photos": photos,
-        }
+    def flag_near_duplicates(photos):
+        for photo in photos:
+            perceptual_hash = photo.pop("perceptual_hash")
+            photo["near_duplicates"] = []
+            if perceptual_hash:
+                photo["near_duplicates"] = similarity_index.similar(
+                    perceptual_hash, exclude=photo["id"]
+                )
+            yield photo
+
+    return stream_json_list(
+        "photos", flag_near_duplicates(photo_store.iter_pendent_photos())
     )
 
 
-@flask_app.route(
+@routes.route("/photos/<string:photo_id>/similar", methods=["GET"])
+@jwt_required()
+def list_similar_photos(photo_id):
+    try:
+        photo = photo_store.get_by_id(photo_id)
+    except InvalidId:
+        return jsonify({"detail": "not found"}), 404
+
+    user_id = get_jwt_identity()
+    user = user_store.get_by_id(user_id)
+    if not user:
+        return jsonify({"detail": "not found"}), 404
+
+    if not user.admin:
+        return jsonify({"detail": "forbidden"}), 403
+
+    if not photo:
+        return jsonify({"detail": "not found"}), 404
+
+    try:
+        max_distance = int(
+            request.args.get("max_distance", config.near_duplicate_distance)
+        )
+    except ValueError:
+        return jsonify({"detail": "invalid max_distance"}), 400
+    # the index probes combinatorially more buckets as the distance grows
+    max_distance = max(0, min(max_distance, 2 * config.near_duplicate_distance))
+
+    photos = []
+    if photo.perceptual_hash:
+        photos = get_photo_similarity_index().similar(
+            photo.perceptual_hash, max_distance=max_distance, exclude=photo_id
+        )
+    return jsonify({"photos": photos})
+
+
+@routes.route("/photos/events", methods=["GET"])
+@jwt_required()
+def photo_events():
+    user_id = get_jwt_identity()
+    user = user_store.get_by_id(user_id)
+    if not user:
+        return jsonify({"detail": "not found"}), 404
+
+    broker = get_photo_event_broker()
+    try:
+        subscription = broker.subscribe(request.headers.get("Last-Event-ID"))
+    except TooManySubscribers:
+        response = jsonify({"detail": "server busy"})
+        response.headers["Retry-After"] = str(SUBSCRIBE_RETRY_SECONDS)
+        return response, 503
+
+    events = stream_photo_events(broker, subscription, admin=user.admin)
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@routes.route(
     "/photos/<string:photo_id>/authorized", methods=["PUT"], endpoint="authorized_photo"
 )
 @jwt_required()
@@ -170,11 +343,15 @@ def photo_authorized(photo_id):
         return jsonify({"detail": "forbidden"}), 403
 
     photo_store.authorized(photo_id)
+    comment_store.set_photo_visible(photo_id)
     return jsonify({"photo_id": photo_id, "status": "authorized"})
 
 
-@flask_app.route("/photos/<string:photo_id>/liked", methods=["POST"])
+@routes.route("/photos/<string:photo_id>/liked", methods=["POST"])
 @jwt_required()
+@rate_limiter.limit("write", config.rate_limit_write)
+@idempotent
+@concurrency_limiter.limit
 def photo_liked(photo_id):
     try:
         photo_store.get_by_id(photo_id)
@@ -183,15 +360,18 @@ def photo_liked(photo_id):
 
     user_id = get_jwt_identity()
     like = Like({"_id": ObjectId(), "photo_id": photo_id, "user_id": user_id})
-    like_store.save(like)
+    like = like_store.save(like)
     return jsonify(like.to_primitive())
 
 
-@flask_app.route("/photos/<string:photo_id>/comment", methods=["POST"])
+@routes.route("/photos/<string:photo_id>/comment", methods=["POST"])
 @jwt_required()
+@rate_limiter.limit("write", config.rate_limit_write)
+@idempotent
+@concurrency_limiter.limit
 def photo_add_comment(photo_id):
     try:
-        photo_store.get_by_id(photo_id)
+        photo = photo_store.get_by_id(photo_id)
     except InvalidId:
         return jsonify({"detail": "not found"}), 404
 
@@ -200,7 +380,105 @@ def photo_add_comment(photo_id):
     text = json_data.get("text")
 
     comment = Comment(
-        {"_id": ObjectId(), "photo_id": photo_id, "user_id": user_id, "text": text}
+        {
+            "_id": ObjectId(),
+            "photo_id": photo_id,
+            "user_id": user_id,
+            "text": text,
+            "photo_visible": bool(photo and photo.visible),
+        }
     )
     comment_store.save(comment)
     return jsonify(comment.to_primitive())
+
+
+@routes.route("/comments/search", methods=["GET"])
+@jwt_required()
+def search_comments():
+    user_id = get_jwt_identity()
+    user = user_store.get_by_id(user_id)
+    if not user:
+        return jsonify({"detail": "not found"}), 404
+
+    if not user.admin:
+        return jsonify({"detail": "forbidden"}), 403
+
+    query = request.args.get("q")
+    if not query:
+        return jsonify({"error": "missing search query"}), 400
+
+    visible = request.args.get("visible")
+    if visible is not None:
+        visible = visible.lower() == "true"
+
+    try:
+        per_page = max(1, min(int(request.args.get("per_page", 20)), 100))
+        comments, next_cursor = comment_store.search(
+            query,
+            photo_id=request.args.get("photo_id"),
+            visible=visible,
+            after=request.args.get("after"),
+            per_page=per_page,
+        )
+    except (ValueError, InvalidId):
+        return jsonify({"detail": "invalid photo_id, per_page or cursor"}), 400
+
+    return jsonify({"comments": comments, "next": next_cursor, "per_page": per_page})
+
+
+@routes.cli.command("ensure-indexes")
+def ensure_indexes_command():
+    """Create the indexes of every collection."""
+    ensure_indexes(get_mongo_db())
+
+
+@routes.cli.command("refresh-trending")
+def refresh_trending():
+    """Recompute the trending photos ranking."""
+    photo_store.trending_store.refresh(like_store, comment_store)
+
+
+@routes.cli.command("migrate-likes")
+def migrate_likes():
+    """Copy likes from the document per like layout into like buckets."""
+    migrated = get_store(LikeBucketStore).migrate_from(get_store(LikeStore))
+    click.echo(f"{migrated} likes migrated")
+
+
+@routes.cli.command("run-migration")
+@click.argument("name", type=click.Choice(sorted(MIGRATIONS)))
+@click.option("--workers", default=4, show_default=True)
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--max-lag", default=10.0, show_default=True)
+def run_migration(name, workers, batch_size, max_lag):
+    """Run, or resume, a registered migration."""
+    migration = MIGRATIONS[name]
+    runner = MigrationRunner(
+        migration,
+        get_store(migration.store_class),
+        get_store(MigrationStore),
+        workers=workers,
+        batch_size=batch_size,
+        max_lag=max_lag,
+    )
+    click.echo(f"{runner.run()} documents processed")
+
+
+def create_app():
+    app = Flask(__name__)
+    app.secret_key = config.secret_key
+    app.url_map.strict_slashes = False
+    app.config["SERVER_NAME"] = config.server_name
+    app.config["JWT_SECRET_KEY"] = config.jwt_secret_key
+    app.json_encoder = OrjsonEncoder
+    if config.trusted_proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=config.trusted_proxies)
+
+    bcrypt.init_app(app)
+    jwt.init_app(app)
+    cors.init_app(app)
+    app.register_blueprint(routes)
+    return app
+
+
+flask_app = create_app()
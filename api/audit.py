@@ -0,0 +1,101 @@
+import logging
+import threading
+
+from api import config
+
+logger = logging.getLogger(__name__)
+
+QUERY_AUDIT_MODES = (None, "log", "raise")
+
+COLLECTION_SCAN_STAGE = "COLLSCAN"
+IN_MEMORY_SORT_STAGES = {"SORT"}
+
+
+class UnindexedQueryError(Exception):
+    pass
+
+
+def query_shape(value):
+    """Replace the values of a query document by their type names, keeping
+    field names and operators, so queries that only differ on parameters
+    share the same shape."""
+    if isinstance(value, dict):
+        return tuple(sorted((key, query_shape(item)) for key, item in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return tuple(query_shape(item) for item in value)
+    return type(value).__name__
+
+
+def iter_plan_stages(plan):
+    if not plan:
+        return
+
+    yield plan.get("stage")
+    for key in ("inputStage", "queryPlan", "outerStage", "innerStage"):
+        yield from iter_plan_stages(plan.get(key))
+
+    for stage in plan.get("inputStages", ()):
+        yield from iter_plan_stages(stage)
+
+
+class QueryAuditor:
+    """Runs `explain` once for each distinct query shape issued through
+    `StorageMixin` and reports collection scans, in-memory sorts and
+    plans that examine too many documents for what they return."""
+
+    def __init__(self, mode=None, max_examined_ratio=10):
+        if mode not in QUERY_AUDIT_MODES:
+            raise ValueError(f"invalid query audit mode: {mode}")
+
+        self.mode = mode
+        self.max_examined_ratio = max_examined_ratio
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def check(self, collection, where, sort=None):
+        if self.mode is None:
+            return
+
+        shape = (collection.full_name, query_shape(where), query_shape(sort))
+        with self.lock:
+            if shape in self.seen:
+                return
+            self.seen.add(shape)
+
+        query = collection.find(where)
+        if sort is not None:
+            query.sort(sort)
+
+        problems = self.inspect(query.explain())
+        if not problems:
+            return
+
+        message = f"{collection.full_name} query {where!r} sort {sort!r}: " + ", ".join(
+            problems
+        )
+        if self.mode == "raise":
+            with self.lock:
+                self.seen.discard(shape)
+            raise UnindexedQueryError(message)
+
+        logger.warning("Unindexed query shape: %s", message)
+
+    def inspect(self, explain):
+        problems = []
+        stages = set(iter_plan_stages(explain["queryPlanner"]["winningPlan"]))
+        if COLLECTION_SCAN_STAGE in stages:
+            problems.append("collection scan")
+
+        if stages & IN_MEMORY_SORT_STAGES:
+            problems.append("in-memory sort")
+
+        stats = explain.get("executionStats", {})
+        examined = stats.get("totalDocsExamined", 0)
+        returned = max(stats.get("nReturned", 0), 1)
+        if examined / returned > self.max_examined_ratio:
+            problems.append(f"examined {examined} documents for {returned} returned")
+
+        return problems
+
+
+query_auditor = QueryAuditor(config.query_audit, config.query_audit_max_ratio)
@@ -7,9 +7,41 @@ mongo_uri = os.environ.get("MONGO_URL", "localhost:27017")
 mongo_db = os.environ.get("MONGO_DB", "photoview")
 mongo_read_preference = os.environ.get("MONGO_READ_PREFERENCE", "PRIMARY")
 
+like_storage = os.environ.get("LIKE_STORAGE", "document")
+like_bucket_size = int(os.environ.get("LIKE_BUCKET_SIZE", 1000))
+
 jwt_secret_key = os.environ.get("JWT_SECRET_KEY", "t1NP63m4wnBg6nyHYKfmc2TpCOGI4nss")
 
 aws_access = os.environ.get("AWS_ACCESS_KEY_ID")
 aws_secret = os.environ.get("AWS_SECRET_ACCESS_KEY")
 s3_bucket = os.environ.get("AWS_S3_BUCKET_NAME")
 s3_host = os.environ.get("AWS_S3_HOST", "https://s3.amazonaws.com")
+
+storage_backend = os.environ.get("STORAGE_BACKEND", "s3")
+local_storage_path = os.environ.get("LOCAL_STORAGE_PATH", "media")
+local_storage_url = os.environ.get("LOCAL_STORAGE_URL", "/files")
+file_cache_path = os.environ.get("FILE_CACHE_PATH")
+file_cache_size = int(os.environ.get("FILE_CACHE_SIZE", 1024**3))
+file_max_age = int(os.environ.get("FILE_MAX_AGE", 365 * 24 * 3600))
+
+query_audit = os.environ.get("QUERY_AUDIT") or None
+query_audit_max_ratio = float(os.environ.get("QUERY_AUDIT_MAX_RATIO", 10))
+
+trusted_proxies = int(os.environ.get("TRUSTED_PROXIES", 0))
+
+rate_limit_backend = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+rate_limit_auth = os.environ.get("RATE_LIMIT_AUTH", "10/60")
+rate_limit_write = os.environ.get("RATE_LIMIT_WRITE", "60/60")
+rate_limit_ttl = int(os.environ.get("RATE_LIMIT_TTL", 3600))
+max_concurrent_requests = int(os.environ.get("MAX_CONCURRENT_REQUESTS", 8))
+max_event_subscribers = int(os.environ.get("MAX_EVENT_SUBSCRIBERS", 16))
+
+trending_window_hours = float(os.environ.get("TRENDING_WINDOW_HOURS", 72))
+trending_half_life_hours = float(os.environ.get("TRENDING_HALF_LIFE_HOURS", 24))
+
+idempotency_ttl = int(os.environ.get("IDEMPOTENCY_TTL", 24 * 3600))
+idempotency_wait = float(os.environ.get("IDEMPOTENCY_WAIT", 10))
+idempotency_lock_timeout = int(os.environ.get("IDEMPOTENCY_LOCK_TIMEOUT", 120))
+
+near_duplicate_distance = int(os.environ.get("NEAR_DUPLICATE_DISTANCE", 8))
+similarity_sync_interval = float(os.environ.get("SIMILARITY_SYNC_INTERVAL", 1))
@@ -0,0 +1,54 @@
+import json
+
+import orjson
+from bson.objectid import ObjectId
+from flask import Response, stream_with_context
+
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+STREAM_CHUNK_SIZE = 100
+
+
+def default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value):
+    return orjson.dumps(value, default=default, option=ORJSON_OPTIONS)
+
+
+class OrjsonEncoder(json.JSONEncoder):
+    """Flask `json_encoder` that serializes through orjson. Formatting
+    arguments such as `indent` and `sort_keys` are accepted and ignored,
+    responses are always compact."""
+
+    def encode(self, value):
+        return dumps(value).decode("utf8")
+
+    def iterencode(self, value, _one_shot=False):
+        yield self.encode(value)
+
+
+def stream_json_list(key, items, **fields):
+    """Stream `{**fields, key: [*items]}` without building the whole list or
+    the whole document in memory."""
+
+    def generate():
+        yield b"{"
+        for name, value in fields.items():
+            yield dumps(name) + b":" + dumps(value) + b","
+        yield dumps(key) + b":["
+
+        separator, chunk = b"", []
+        for item in items:
+            chunk.append(dumps(item))
+            if len(chunk) == STREAM_CHUNK_SIZE:
+                yield separator + b",".join(chunk)
+                separator, chunk = b",", []
+        if chunk:
+            yield separator + b",".join(chunk)
+
+        yield b"]}\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
@@ -0,0 +1,222 @@
+import logging
+import queue
+import threading
+import time
+
+from pymongo.errors import OperationFailure
+
+from api import config
+from api.encoders import dumps
+from api.process import per_process
+from api.store import PhotoStore, get_store
+
+logger = logging.getLogger(__name__)
+
+HISTORY_SIZE = 1000
+SUBSCRIBER_QUEUE_SIZE = 100
+KEEPALIVE_SECONDS = 15
+WATCH_RETRY_SECONDS = 5
+SUBSCRIBE_RETRY_SECONDS = 30
+# the resume token is older than the oplog, changes since then are lost
+CHANGE_STREAM_HISTORY_LOST = 286
+RESET_EVENT = {"id": None, "type": "reset"}
+
+PHOTO_CHANGES_PIPELINE = [
+    {
+        "$match": {
+            "$or": [
+                {"operationType": "insert"},
+                {
+                    "operationType": "update",
+                    "updateDescription.updatedFields.visible": {"$exists": True},
+                },
+            ]
+        }
+    }
+]
+
+
+def change_to_event(change):
+    photo = change.get("fullDocument")
+    if photo is None:
+        return
+
+    event_type = (
+        "photo.created" if change["operationType"] == "insert" else "photo.visible"
+    )
+    return {
+        "id": change["_id"]["_data"],
+        "type": event_type,
+        "photo": {
+            "id": str(photo["_id"]),
+            "uri": photo.get("URI"),
+            "visible": photo.get("visible", False),
+        },
+    }
+
+
+def format_event(event):
+    data = dumps({"type": event["type"], "photo": event["photo"]}).decode("utf8")
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+class Subscription:
+    def __init__(self, backlog):
+        self.backlog = backlog
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.active = True
+
+
+class PhotoEventBroker:
+    """Fans out photo events to the subscribers of this process and keeps
+    the latest ones so reconnecting clients can resume from the id of the
+    last event they received."""
+
+    def __init__(
+        self, history_size=HISTORY_SIZE, max_subscribers=config.max_event_subscribers
+    ):
+        self.history = []
+        self.history_size = history_size
+        self.max_subscribers = max_subscribers
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def publish(self, event):
+        with self.lock:
+            self.history.append(event)
+            del self.history[: -self.history_size]
+            subscribers = list(self.subscribers)
+
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(event)
+            except queue.Full:
+                # slow client, end its stream so it reconnects and replays
+                self.unsubscribe(subscription)
+
+    def subscribe(self, last_event_id=None):
+        """Returns a subscription whose backlog holds the events published
+        after `last_event_id`, or None when that event is no longer
+        known and the client has to reload its state. Raises
+        TooManySubscribers when the streams of this process already hold
+        `max_subscribers` threads, leaving the others to regular requests."""
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                raise TooManySubscribers()
+
+            backlog = []
+            if last_event_id:
+                ids = [event["id"] for event in self.history]
+                if last_event_id in ids:
+                    backlog = self.history[ids.index(last_event_id) + 1 :]
+                else:
+                    backlog = None
+
+            subscription = Subscription(backlog)
+            self.subscribers.add(subscription)
+        return subscription
+
+    def reset(self):
+        """Drop the history and tell subscribers to reload their state,
+        after events were missed."""
+        with self.lock:
+            self.history = []
+            subscribers = list(self.subscribers)
+
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(RESET_EVENT)
+            except queue.Full:
+                self.unsubscribe(subscription)
+
+    def unsubscribe(self, subscription):
+        subscription.active = False
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+
+class PhotoChangeWatcher:
+    """Single change stream on the `photo` collection per process,
+    publishing inserts and visibility changes to the broker."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.resume_token = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.watch()
+            except OperationFailure as error:
+                if error.code != CHANGE_STREAM_HISTORY_LOST:
+                    logger.exception("Photo change stream failed, retrying")
+                    time.sleep(WATCH_RETRY_SECONDS)
+                    continue
+
+                logger.warning("Photo change stream history lost, resetting")
+                self.resume_token = None
+                self.broker.reset()
+            except Exception:
+                # keep the thread alive, nothing else would restart it
+                logger.exception("Photo change stream failed, retrying")
+                time.sleep(WATCH_RETRY_SECONDS)
+
+    def watch(self):
+        photos = get_store(PhotoStore).db
+        with photos.watch(
+            PHOTO_CHANGES_PIPELINE,
+            full_document="updateLookup",
+            resume_after=self.resume_token,
+        ) as stream:
+            for change in stream:
+                self.resume_token = stream.resume_token
+                event = change_to_event(change)
+                if event is not None:
+                    self.broker.publish(event)
+
+
+@per_process
+def get_photo_event_broker():
+    broker = PhotoEventBroker()
+    PhotoChangeWatcher(broker).start()
+    return broker
+
+
+def stream_photo_events(broker, subscription, admin=False):
+    """Server-Sent Events for a subscription. Regular users only see photos
+    turning visible, admins also see new uploads."""
+    try:
+        if subscription.backlog is None:
+            yield "event: reset\ndata: {}\n\n"
+
+        for event in subscription.backlog or ():
+            if admin or event["photo"]["visible"]:
+                yield format_event(event)
+
+        while subscription.active:
+            try:
+                event = subscription.queue.get(timeout=KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+
+            if event is RESET_EVENT:
+                yield "event: reset\ndata: {}\n\n"
+                continue
+
+            if admin or event["photo"]["visible"]:
+                yield format_event(event)
+    finally:
+        broker.unsubscribe(subscription)
@@ -0,0 +1,178 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from werkzeug.security import safe_join
+
+from api import config
+from api.process import per_process
+
+COPY_CHUNK_SIZE = 1024 * 1024
+TEMP_PREFIX = ".upload-"
+# older temporary files were left by a crashed worker, newer ones may still
+# be written by a sibling worker sharing the directory
+STALE_TEMP_SECONDS = 3600
+
+
+def write_file(path, fill):
+    """Write a file through `fill(fileobj)` into a temporary file renamed
+    over `path`, so readers never see a partial file. Returns the size of
+    the file, or None when `fill` returns False."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=TEMP_PREFIX)
+    try:
+        with os.fdopen(fd, "wb") as fileobj:
+            if fill(fileobj) is False:
+                os.unlink(temp_path)
+                return None
+            size = fileobj.tell()
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return size
+
+
+def remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class FileBackend:
+    """Where uploaded photos are stored. `save` returns the URI clients
+    load the file from, `get_path` the local path `/files/<key>` serves
+    it from, or None when the file is not served by this API."""
+
+    def save(self, key, stream):
+        raise NotImplementedError
+
+    def get_path(self, key):
+        raise NotImplementedError
+
+
+class LocalFileBackend(FileBackend):
+    def __init__(self, root, base_url):
+        # send_file resolves relative paths against the app package, not
+        # the working directory
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip("/")
+
+    def save(self, key, stream):
+        path = safe_join(self.root, key)
+        # keys are content addressed, an existing file has the same bytes
+        if not os.path.exists(path):
+            write_file(
+                path,
+                lambda fileobj: shutil.copyfileobj(stream, fileobj, COPY_CHUNK_SIZE),
+            )
+        return f"{self.base_url}/{key}"
+
+    def get_path(self, key):
+        path = safe_join(self.root, key)
+        if path is None or not os.path.isfile(path):
+            return None
+        return path
+
+
+class LRUFileCache:
+    """Files on local disk bounded to `max_bytes`, evicting the least
+    recently read first. Each worker process keeps its own accounting of
+    the shared directory, so `max_bytes` applies per worker and a file
+    evicted by one worker is filled again by the others on their next
+    read."""
+
+    def __init__(self, root, max_bytes):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        os.makedirs(self.root, exist_ok=True)
+        files = []
+        now = time.time()
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                if name.startswith(TEMP_PREFIX):
+                    if now - stat.st_mtime > STALE_TEMP_SECONDS:
+                        remove_file(path)
+                    continue
+                files.append((stat.st_atime, os.path.relpath(path, self.root), stat))
+
+        for _, key, stat in sorted(files):
+            self.entries[key] = stat.st_size
+            self.total_bytes += stat.st_size
+        self.evict()
+
+    def get_or_fill(self, key, fill):
+        path = safe_join(self.root, key)
+        if path is None:
+            return None
+
+        with self.lock:
+            cached = self.touch(key, path)
+        if cached:
+            return path
+
+        size = write_file(path, fill)
+        if size is None:
+            return None
+
+        with self.lock:
+            if key not in self.entries:
+                self.total_bytes += size
+            self.entries[key] = size
+            self.entries.move_to_end(key)
+            self.evict()
+        return path
+
+    def touch(self, key, path):
+        """Mark `key` as read when its file is on disk, whether this worker
+        or a sibling filled it. Returns whether it is."""
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            # evicted by another worker
+            self.total_bytes -= self.entries.pop(key, 0)
+            return False
+
+        if key not in self.entries:
+            self.total_bytes += size
+            self.entries[key] = size
+        self.entries.move_to_end(key)
+        self.evict()
+        return True
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            remove_file(os.path.join(self.root, key))
+
+
+@per_process
+def get_file_backend():
+    if config.storage_backend == "local":
+        return LocalFileBackend(config.local_storage_path, config.local_storage_url)
+
+    from api.s3 import S3FileBackend
+
+    cache = None
+    if config.file_cache_path:
+        cache = LRUFileCache(config.file_cache_path, config.file_cache_size)
+    return S3FileBackend(cache, config.local_storage_url)
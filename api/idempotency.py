@@ -0,0 +1,79 @@
+import time
+from functools import wraps
+
+from flask import Response, jsonify, make_response, request
+from flask_jwt_extended import get_jwt_identity
+
+from api import config
+from api.store import IdempotencyStore, get_store
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+POLL_INTERVAL_SECONDS = 0.1
+
+
+def wait_for_completion(store, record):
+    deadline = time.monotonic() + config.idempotency_wait
+    while record is not None and record.status == "pending":
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(POLL_INTERVAL_SECONDS)
+        record = store.get_by_id(record._id)
+    return record
+
+
+def replay(record):
+    return Response(
+        record.response_body,
+        status=record.response_status,
+        mimetype="application/json",
+        headers={"Idempotent-Replayed": "true"},
+    )
+
+
+def idempotent(fn):
+    """Run a write once per `Idempotency-Key` header and user, replaying the
+    stored response to retries. A retry arriving while the first request
+    is running waits for it to finish. Requires a verified JWT."""
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return fn(*args, **kwargs)
+
+        if len(key) > 255:
+            return jsonify({"error": f"{IDEMPOTENCY_HEADER} too long"}), 400
+
+        store = get_store(IdempotencyStore)
+        endpoint = f"{request.method} {request.path}"
+        record, owner = store.start(get_jwt_identity(), key, endpoint)
+
+        if not owner:
+            if record.endpoint != endpoint:
+                error = f"{IDEMPOTENCY_HEADER} already used for another request"
+                return jsonify({"error": error}), 422
+
+            record = wait_for_completion(store, record)
+            if record is None or record.status == "pending":
+                response = jsonify({"detail": "request in progress"})
+                response.headers["Retry-After"] = "1"
+                return response, 409
+            return replay(record)
+
+        try:
+            response = make_response(fn(*args, **kwargs))
+        except Exception:
+            store.discard(record._id)
+            raise
+
+        # server errors and rejections for load are not stored, a retry
+        # should run the request again
+        if response.status_code >= 500 or response.status_code in (409, 429):
+            store.discard(record._id)
+        else:
+            store.complete(
+                record._id, response.status_code, response.get_data(as_text=True)
+            )
+        return response
+
+    return wrapper
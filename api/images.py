@@ -0,0 +1,91 @@
+import base64
+import io
+import mimetypes
+
+from PIL import Image, UnidentifiedImageError
+
+PLACEHOLDER_SIZE = (16, 16)
+PLACEHOLDER_QUALITY = 50
+DHASH_SIZE = 8
+
+EXIF_ORIENTATION = 0x0112
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+ORIENTATION_SWAPS_AXES = {5, 6, 7, 8}
+
+
+def get_placeholder(image, orientation=1):
+    """Tiny JPEG data URI of the image, upright, for clients to show while
+    the original loads."""
+    # lets JPEG decode at a reduced scale instead of full resolution
+    image.draft("RGB", PLACEHOLDER_SIZE)
+    thumbnail = image.convert("RGB")
+    thumbnail.thumbnail(PLACEHOLDER_SIZE)
+    if orientation in ORIENTATION_TRANSPOSE:
+        thumbnail = thumbnail.transpose(ORIENTATION_TRANSPOSE[orientation])
+
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, "JPEG", quality=PLACEHOLDER_QUALITY)
+    encoded = base64.b64encode(buffer.getvalue()).decode("ascii")
+    return f"data:image/jpeg;base64,{encoded}"
+
+
+def get_perceptual_hash(image):
+    """64 bit difference hash (dHash) as 16 hex digits: whether each pixel
+    of a 9x8 grayscale thumbnail is brighter than its right neighbour.
+    Re-encoded, resized or slightly edited copies of an image get hashes
+    a few bits apart."""
+    thumbnail = image.convert("L").resize(
+        (DHASH_SIZE + 1, DHASH_SIZE), Image.Resampling.LANCZOS
+    )
+    pixels = list(thumbnail.getdata())
+    value = 0
+    for row in range(DHASH_SIZE):
+        for column in range(DHASH_SIZE):
+            offset = row * (DHASH_SIZE + 1) + column
+            value = value << 1 | (pixels[offset] > pixels[offset + 1])
+    return f"{value:016x}"
+
+
+def get_image_metadata(file):
+    """Size, type, upright dimensions, EXIF orientation, placeholder and
+    perceptual hash of an uploaded image. Only what is known is returned
+    when the file is not an image Pillow can read. The stream is rewound so
+    it can be uploaded afterwards."""
+    stream = file.stream
+    metadata = {
+        "size": stream.seek(0, io.SEEK_END),
+        "mime_type": file.mimetype or mimetypes.guess_type(file.filename)[0],
+    }
+    stream.seek(0)
+
+    try:
+        with Image.open(stream) as image:
+            width, height = image.size
+            orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+            # dimensions as displayed, like the placeholder
+            if orientation in ORIENTATION_SWAPS_AXES:
+                width, height = height, width
+            metadata.update(
+                {
+                    "width": width,
+                    "height": height,
+                    "mime_type": Image.MIME.get(image.format, metadata["mime_type"]),
+                    "orientation": orientation,
+                    "placeholder": get_placeholder(image, orientation),
+                    "perceptual_hash": get_perceptual_hash(image),
+                }
+            )
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        pass
+    finally:
+        stream.seek(0)
+
+    return metadata
@@ -0,0 +1,215 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+from api.models import MigrationCheckpoint
+from api.store import CommentStore, PhotoStore, get_store
+
+logger = logging.getLogger(__name__)
+
+MAX_THROTTLE_SECONDS = 30
+
+MIGRATIONS = {}
+
+
+class Migration:
+    def __init__(self, name, store_class, transform, where=None):
+        self.name = name
+        self.store_class = store_class
+        self.transform = transform
+        self.where = where or {}
+
+
+def migration(name, store_class, where=None):
+    """Register `transform` as a migration over the collection of
+    `store_class`. It gets each batch of raw documents matching `where` and
+    returns, for each document, the fields to set with the document `_id`,
+    or None to leave it as is."""
+
+    def decorator(transform):
+        MIGRATIONS[name] = Migration(name, store_class, transform, where)
+        return transform
+
+    return decorator
+
+
+class MigrationRunner:
+    """Applies a migration over `_id` ranges processed in parallel, writing
+    through `bulk_upsert_by_id` in batches. Progress is checkpointed after
+    each batch so an interrupted run resumes where it stopped, and writes
+    pause while secondaries lag more than `max_lag` seconds behind."""
+
+    def __init__(
+        self,
+        migration,
+        store,
+        checkpoint_store,
+        workers=4,
+        batch_size=500,
+        max_lag=10,
+        sleep=time.sleep,
+    ):
+        self.migration = migration
+        self.store = store
+        self.checkpoint_store = checkpoint_store
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_lag = max_lag
+        self.sleep = sleep
+
+    def run(self):
+        checkpoints = self.checkpoint_store.get_checkpoints(self.migration.name)
+        if checkpoints and checkpoints[0].ranges not in (None, len(checkpoints)):
+            # a run stopped while writing its plan, before migrating anything
+            self.checkpoint_store.db.delete_many({"migration": self.migration.name})
+            checkpoints = []
+        if not checkpoints:
+            checkpoints = self.create_checkpoints()
+
+        pending = [checkpoint for checkpoint in checkpoints if not checkpoint.done]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            processed = sum(executor.map(self.run_range, pending))
+
+        return processed
+
+    def get_boundary_id(self, order):
+        documents = self.store.find_without_format(
+            self.migration.where,
+            sort=[("_id", order)],
+            limit=1,
+            fields={"_id": True},
+        )
+        for document in documents:
+            return document["_id"]
+
+    def split_ranges(self):
+        """Split the `_id` space between the first and last documents into
+        ranges of equal time span. The outer ranges are left open so
+        documents inserted during the run are migrated too."""
+        first_id = self.get_boundary_id(ASCENDING)
+        last_id = self.get_boundary_id(DESCENDING)
+        if first_id is None:
+            return [(None, None)]
+
+        first_at = first_id.generation_time
+        span = (last_id.generation_time - first_at) / self.workers
+        boundaries = [
+            ObjectId.from_datetime(first_at + span * index)
+            for index in range(1, self.workers)
+        ]
+        boundaries = sorted(set(boundaries) - {ObjectId.from_datetime(first_at)})
+        return list(zip([None] + boundaries, boundaries + [None]))
+
+    def create_checkpoints(self):
+        ranges = self.split_ranges()
+        checkpoints = [
+            MigrationCheckpoint(
+                {
+                    "_id": f"{self.migration.name}:{index:04d}",
+                    "migration": self.migration.name,
+                    "start": start,
+                    "end": end,
+                    "ranges": len(ranges),
+                }
+            )
+            for index, (start, end) in enumerate(ranges)
+        ]
+        self.checkpoint_store.save_many(checkpoints)
+        return checkpoints
+
+    def run_range(self, checkpoint):
+        processed = 0
+        last_id = checkpoint.last_id
+        while True:
+            self.throttle()
+
+            id_range = {}
+            if last_id is not None:
+                id_range["$gt"] = last_id
+            elif checkpoint.start is not None:
+                id_range["$gte"] = checkpoint.start
+            if checkpoint.end is not None:
+                id_range["$lt"] = checkpoint.end
+
+            where = dict(self.migration.where)
+            if id_range:
+                where["_id"] = id_range
+
+            documents = list(
+                self.store.find_without_format(
+                    where, sort=[("_id", ASCENDING)], limit=self.batch_size
+                )
+            )
+            if not documents:
+                self.checkpoint_store.db.update_one(
+                    {"_id": checkpoint._id},
+                    {"$set": {"done": True, "updated_at": datetime.utcnow()}},
+                )
+                return processed
+
+            changes = self.migration.transform(documents)
+            changes = [change for change in changes if change is not None]
+            if changes:
+                self.store.bulk_upsert_by_id(changes)
+
+            last_id = documents[-1]["_id"]
+            processed += len(documents)
+            self.checkpoint_store.db.update_one(
+                {"_id": checkpoint._id},
+                {
+                    "$set": {"last_id": last_id, "updated_at": datetime.utcnow()},
+                    "$inc": {"processed": len(documents)},
+                },
+            )
+
+    def replication_lag(self):
+        client = self.store.db.database.client
+        try:
+            status = client.admin.command("replSetGetStatus")
+        except OperationFailure:
+            # not a replica set, nothing to wait for
+            return 0
+
+        members = status["members"]
+        primary_optimes = [
+            member["optimeDate"]
+            for member in members
+            if member["stateStr"] == "PRIMARY"
+        ]
+        secondary_optimes = [
+            member["optimeDate"]
+            for member in members
+            if member["stateStr"] == "SECONDARY"
+        ]
+        if not primary_optimes or not secondary_optimes:
+            return 0
+        return (primary_optimes[0] - min(secondary_optimes)).total_seconds()
+
+    def throttle(self):
+        lag = self.replication_lag()
+        while lag > self.max_lag:
+            logger.info("Replication lag is %ss, pausing migration", lag)
+            self.sleep(min(lag, MAX_THROTTLE_SECONDS))
+            lag = self.replication_lag()
+
+
+@migration(
+    "comment-photo-visible", CommentStore, where={"photo_visible": {"$exists": False}}
+)
+def comment_photo_visible(comments):
+    """Backfill the photo visibility copied on comments for search."""
+    photos = get_store(PhotoStore).find_without_format(
+        {"_id": {"$in": list({comment["photo_id"] for comment in comments})}},
+        limit=None,
+        fields={"visible": True},
+    )
+    visible_ids = {photo["_id"] for photo in photos if photo.get("visible")}
+    return [
+        {"_id": comment["_id"], "photo_visible": comment["photo_id"] in visible_ids}
+        for comment in comments
+    ]
@@ -1,7 +1,16 @@
 from flask_bcrypt import check_password_hash, generate_password_hash
 from schematics.contrib.mongo import ObjectIdType
 from schematics.models import Model
-from schematics.types import BooleanType, DateTimeType, EmailType, StringType
+from schematics.types import (
+    BooleanType,
+    DateTimeType,
+    EmailType,
+    FloatType,
+    IntType,
+    ListType,
+    ModelType,
+    StringType,
+)
 
 
 class User(Model):
@@ -16,6 +25,14 @@ class User(Model):
 class Photo(Model):
     _id = ObjectIdType(required=True)
     URI = StringType(required=True)
+    content_hash = StringType()
+    mime_type = StringType()
+    size = IntType()
+    width = IntType()
+    height = IntType()
+    orientation = IntType()
+    placeholder = StringType()
+    perceptual_hash = StringType(regex="^[0-9a-f]{16}$")
     user_id = ObjectIdType(required=True)
     visible = BooleanType(default=False)
     created_at = DateTimeType()
@@ -26,6 +43,7 @@ class Comment(Model):
     photo_id = ObjectIdType(required=True)
     user_id = ObjectIdType(required=True)
     text = StringType(required=True)
+    photo_visible = BooleanType(default=False)
     created_at = DateTimeType()
 
 
@@ -34,3 +52,51 @@ class Like(Model):
     photo_id = ObjectIdType(required=True)
     user_id = ObjectIdType(required=True)
     created_at = DateTimeType()
+
+
+class LikeBucket(Model):
+    _id = ObjectIdType(required=True)
+    photo_id = ObjectIdType(required=True)
+    count = IntType(default=0)
+    likes = ListType(ModelType(Like), default=list)
+    created_at = DateTimeType()
+    updated_at = DateTimeType()
+
+
+class TrendingPhoto(Model):
+    _id = ObjectIdType(required=True)
+    URI = StringType(required=True)
+    visible = BooleanType(default=False)
+    like_score = FloatType(default=0)
+    comment_score = FloatType(default=0)
+    score = FloatType(default=0)
+    refreshed_at = DateTimeType()
+
+
+class IdempotencyRecord(Model):
+    _id = ObjectIdType(required=True)
+    user_id = ObjectIdType(required=True)
+    key = StringType(required=True, max_length=255)
+    endpoint = StringType(required=True)
+    status = StringType(choices=("pending", "completed"), default="pending")
+    response_status = IntType()
+    response_body = StringType()
+    created_at = DateTimeType()
+
+
+class MigrationCheckpoint(Model):
+    _id = StringType(required=True)
+    migration = StringType(required=True)
+    start = ObjectIdType()
+    end = ObjectIdType()
+    ranges = IntType()
+    last_id = ObjectIdType()
+    processed = IntType(default=0)
+    done = BooleanType(default=False)
+    updated_at = DateTimeType()
+
+
+class RateLimitBucket(Model):
+    _id = StringType(required=True)
+    tokens = FloatType(required=True)
+    updated_at = DateTimeType()
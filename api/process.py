@@ -0,0 +1,26 @@
+import os
+import threading
+from functools import update_wrapper
+
+
+class per_process:
+    """Decorate a factory so that its value is built on first call and then
+    shared by the threads of the process. Clients must not be shared across
+    a fork, so the value is dropped in a forked child, which builds its own.
+    """
+
+    def __init__(self, factory):
+        update_wrapper(self, factory)
+        self.factory = factory
+        self.reset()
+        os.register_at_fork(after_in_child=self.reset)
+
+    def __call__(self):
+        with self.lock:
+            if self.value is None:
+                self.value = self.factory()
+            return self.value
+
+    def reset(self):
+        self.value = None
+        self.lock = threading.Lock()
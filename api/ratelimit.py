@@ -0,0 +1,132 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import jsonify, request
+from flask_jwt_extended import get_jwt_identity
+
+from api import config
+from api.store import RateLimitStore, get_store
+
+
+def parse_rate(rate):
+    """Parse a `"<requests>/<seconds>"` rate into the bucket capacity and
+    its refill rate in tokens per second."""
+    capacity, period = rate.split("/")
+    return int(capacity), int(capacity) / float(period)
+
+
+def get_client_key():
+    try:
+        identity = get_jwt_identity()
+    except RuntimeError:
+        identity = None
+
+    if identity:
+        return f"user:{identity}"
+    return f"ip:{request.remote_addr}"
+
+
+class MemoryBackend:
+    """Token buckets kept in the worker process memory, at most `max_keys`
+    of them. Past that, the buckets left untouched the longest are dropped
+    first, they are the most likely to have refilled."""
+
+    def __init__(self, clock=time.monotonic, max_keys=100_000):
+        self.clock = clock
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def consume(self, key, capacity, refill_rate):
+        now = self.clock()
+        with self.lock:
+            tokens, updated_at = self.buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * refill_rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+
+        return allowed, tokens
+
+    def reset(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class MongoBackend:
+    """Token buckets shared by every worker through the `rate_limit`
+    collection."""
+
+    def consume(self, key, capacity, refill_rate):
+        return get_store(RateLimitStore).consume(key, capacity, refill_rate)
+
+    def reset(self):
+        get_store(RateLimitStore).db.delete_many({})
+
+
+RATE_LIMIT_BACKENDS = {"memory": MemoryBackend, "mongo": MongoBackend}
+
+
+class RateLimiter:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def limit(self, scope, rate):
+        """Reject requests over `rate` for each client of `scope` with a 429,
+        before the view runs. Clients are keyed by JWT identity, or by IP
+        address when the request is anonymous."""
+        capacity, refill_rate = parse_rate(rate)
+
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                key = f"{scope}:{get_client_key()}"
+                allowed, tokens = self.backend.consume(key, capacity, refill_rate)
+                if not allowed:
+                    retry_after = math.ceil((1 - tokens) / refill_rate)
+                    response = jsonify({"detail": "too many requests"})
+                    response.headers["Retry-After"] = str(retry_after)
+                    return response, 429
+                return fn(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def reset(self):
+        self.backend.reset()
+
+
+class ConcurrencyLimiter:
+    def __init__(self, max_concurrent):
+        self.semaphore = threading.BoundedSemaphore(max_concurrent)
+
+    def limit(self, fn):
+        """Shed load with a 503 when too many limited requests are already
+        running in this worker."""
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not self.semaphore.acquire(blocking=False):
+                response = jsonify({"detail": "server busy"})
+                response.headers["Retry-After"] = "1"
+                return response, 503
+
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.semaphore.release()
+
+        return wrapper
+
+
+rate_limiter = RateLimiter(RATE_LIMIT_BACKENDS[config.rate_limit_backend]())
+concurrency_limiter = ConcurrencyLimiter(config.max_concurrent_requests)
@@ -1,14 +1,22 @@
-import boto3
-from bson.objectid import ObjectId
+import hashlib
+import os
+from functools import partial
+
 from furl import furl
 
 from api import config
+from api.files import FileBackend, get_file_backend
+from api.process import per_process
 
-s3_session = boto3.Session()
+HASH_CHUNK_SIZE = 1024 * 1024
 
 
+@per_process
 def get_s3_bucket():
-    s3 = s3_session.resource(
+    # boto3 is slow to import, keep it out of the app import path
+    import boto3
+
+    s3 = boto3.Session().resource(
         "s3",
         aws_access_key_id=config.aws_access,
         aws_secret_access_key=config.aws_secret,
@@ -16,12 +24,52 @@ def get_s3_bucket():
     return s3.Bucket(config.s3_bucket)
 
 
-def get_s3_key(file_name):
-    return f"{ObjectId()}-{file_name}"
+class S3FileBackend(FileBackend):
+    """Stores photos in the S3 bucket. When a cache is given, photos are
+    read through `/files/<key>` from an on-disk cache filled from the
+    bucket, otherwise straight from S3."""
+
+    def __init__(self, cache=None, base_url="/files"):
+        self.cache = cache
+        self.base_url = base_url.rstrip("/")
+
+    def save(self, key, stream):
+        get_s3_bucket().upload_fileobj(stream, key)
+        if self.cache is not None:
+            return f"{self.base_url}/{key}"
+        return furl(f"{config.s3_host}/{config.s3_bucket}/{key}").url
+
+    def download(self, key, fileobj):
+        from botocore.exceptions import ClientError
+
+        try:
+            get_s3_bucket().download_fileobj(key, fileobj)
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise
+
+    def get_path(self, key):
+        if self.cache is None:
+            return None
+        return self.cache.get_or_fill(key, partial(self.download, key))
+
+
+def get_content_hash(file):
+    """SHA-256 of the uploaded file, read in chunks. The stream is rewound
+    so it can be uploaded afterwards."""
+    content_hash = hashlib.sha256()
+    for chunk in iter(partial(file.stream.read, HASH_CHUNK_SIZE), b""):
+        content_hash.update(chunk)
+    file.stream.seek(0)
+    return content_hash.hexdigest()
+
+
+def get_s3_key(file_name, content_hash):
+    _, extension = os.path.splitext(file_name)
+    return f"{content_hash}{extension.lower()}"
 
 
-def get_s3_uri(file):
-    bucket = get_s3_bucket()
-    key = get_s3_key(file.filename)
-    bucket.Object(key).put(Body=file.read())
-    return furl(f"{config.s3_host}/{config.s3_bucket}/{key}").url
+def get_s3_uri(file, content_hash):
+    key = get_s3_key(file.filename, content_hash)
+    return get_file_backend().save(key, file.stream)
@@ -0,0 +1,216 @@
+import math
+import threading
+import time
+from datetime import timedelta
+from functools import lru_cache
+from itertools import combinations
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+
+from api import config
+from api.process import per_process
+from api.store import PhotoStore, get_store
+
+HASH_BITS = 64
+MAX_HASH_CHUNKS = 16
+# photos inserted by other workers may carry slightly older ids than the
+# newest one already indexed, each sync re-reads this window
+SYNC_OVERLAP = timedelta(seconds=60)
+
+
+def popcount(value):
+    return bin(value).count("1")
+
+
+# int.bit_count is only available from Python 3.10
+popcount = getattr(int, "bit_count", popcount)
+
+
+def hamming_distance(first, second):
+    return popcount(first ^ second)
+
+
+def get_chunk_count(size, max_distance, bits=HASH_BITS):
+    """Number of substrings that makes searches within `max_distance` bits
+    cheapest for `size` hashes: fewer substrings mean wider buckets to
+    probe around each query substring, more mean fuller buckets to check.
+    The optimum is close to `bits / log2(size)`, see Norouzi et al., "Fast
+    Search in Hamming Space with Multi-Index Hashing"."""
+
+    def cost(chunks):
+        width = bits // chunks
+        radius = max_distance // chunks
+        probes = chunks * sum(
+            math.factorial(width)
+            // (math.factorial(distance) * math.factorial(width - distance))
+            for distance in range(radius + 1)
+        )
+        return probes * (1 + 2 * size / 2**width)
+
+    return min(range(1, MAX_HASH_CHUNKS + 1), key=cost)
+
+
+@lru_cache(maxsize=None)
+def get_flip_masks(bits, radius):
+    """XOR masks flipping up to `radius` of `bits` bits."""
+    masks = []
+    for distance in range(radius + 1):
+        for flipped in combinations(range(bits), distance):
+            masks.append(sum(1 << bit for bit in flipped))
+    return tuple(masks)
+
+
+class MultiIndexHash:
+    """Multi-index hashing over fixed size binary hashes. Each hash is split
+    into substrings indexed in their own table. Two hashes within `r` bits
+    of each other have at least one substring within `r // chunks` bits, so
+    a search only probes the buckets around the query substrings and
+    checks the few candidates found there. The number of substrings
+    follows the number of hashes, the tables are rebuilt when it changes."""
+
+    def __init__(self, bits=HASH_BITS, max_distance=8):
+        self.bits = bits
+        self.max_distance = max_distance
+        self.hashes = {}
+        # tables hold hash values, shared by the keys of identical hashes
+        self.keys = {}
+        self.build(get_chunk_count(0, max_distance, bits))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def build(self, chunks):
+        self.chunks = chunks
+        self.layout = []
+        offset = 0
+        for index in range(chunks):
+            width = (self.bits - offset) // (chunks - index)
+            self.layout.append((offset, (1 << width) - 1, width))
+            offset += width
+
+        self.tables = [{} for _ in range(chunks)]
+        for value in self.keys:
+            self.index(value)
+
+    def split(self, value):
+        return [(value >> offset) & mask for offset, mask, _ in self.layout]
+
+    def index(self, value):
+        for table, chunk in zip(self.tables, self.split(value)):
+            table.setdefault(chunk, set()).add(value)
+
+    def add(self, key, value):
+        self.remove(key)
+        self.hashes[key] = value
+        if value in self.keys:
+            self.keys[value].add(key)
+        else:
+            self.keys[value] = {key}
+            self.index(value)
+
+        # re-plan whenever the index doubles in size
+        size = len(self.keys)
+        if size & (size - 1) == 0:
+            chunks = get_chunk_count(size, self.max_distance, self.bits)
+            if chunks != self.chunks:
+                self.build(chunks)
+
+    def remove(self, key):
+        value = self.hashes.pop(key, None)
+        if value is None:
+            return
+
+        keys = self.keys[value]
+        keys.discard(key)
+        if keys:
+            return
+
+        del self.keys[value]
+        for table, chunk in zip(self.tables, self.split(value)):
+            table[chunk].discard(value)
+            if not table[chunk]:
+                del table[chunk]
+
+    def search(self, value, max_distance):
+        """Keys of the hashes within `max_distance` bits of `value`, closest
+        first, as `(distance, key)` pairs."""
+        radius = max_distance // self.chunks
+        candidates = set()
+        for table, chunk, (_, _, width) in zip(
+            self.tables, self.split(value), self.layout
+        ):
+            probes = map(chunk.__xor__, get_flip_masks(width, radius))
+            candidates.update(*filter(None, map(table.get, probes)))
+
+        candidates = list(candidates)
+        distances = map(popcount, map(value.__xor__, candidates))
+        return sorted(
+            (distance, key)
+            for candidate, distance in zip(candidates, distances)
+            if distance <= max_distance
+            for key in self.keys[candidate]
+        )
+
+
+class PhotoSimilarityIndex:
+    """Perceptual hashes of all photos, loaded from Mongo on first use and
+    kept up to date by reading the photos inserted since the last sync."""
+
+    def __init__(self, photo_store, sync_interval=config.similarity_sync_interval):
+        self.photo_store = photo_store
+        self.sync_interval = sync_interval
+        self.index = MultiIndexHash(max_distance=config.near_duplicate_distance)
+        self.last_id = None
+        self.synced_at = None
+        self.lock = threading.Lock()
+
+    def sync(self):
+        where = {"perceptual_hash": {"$type": "string"}}
+        if self.last_id is not None:
+            since = self.last_id.generation_time - SYNC_OVERLAP
+            where["_id"] = {"$gte": ObjectId.from_datetime(since)}
+
+        photos = self.photo_store.find_without_format(
+            where,
+            sort=[("_id", ASCENDING)],
+            limit=None,
+            fields={"_id": True, "perceptual_hash": True},
+        )
+        for photo in photos:
+            self.index.add(str(photo["_id"]), int(photo["perceptual_hash"], 16))
+            if self.last_id is None or photo["_id"] > self.last_id:
+                self.last_id = photo["_id"]
+        self.synced_at = time.monotonic()
+
+    def refresh(self):
+        with self.lock:
+            if (
+                self.synced_at is None
+                or time.monotonic() - self.synced_at >= self.sync_interval
+            ):
+                self.sync()
+
+    def add(self, photo_id, perceptual_hash):
+        with self.lock:
+            self.index.add(str(photo_id), int(perceptual_hash, 16))
+
+    def similar(self, perceptual_hash, max_distance=None, exclude=None):
+        """Photos whose perceptual hash is within `max_distance` bits of
+        `perceptual_hash`, closest first."""
+        if max_distance is None:
+            max_distance = config.near_duplicate_distance
+
+        self.refresh()
+        with self.lock:
+            results = self.index.search(int(perceptual_hash, 16), max_distance)
+        return [
+            {"id": key, "distance": distance}
+            for distance, key in results
+            if key != exclude
+        ]
+
+
+@per_process
+def get_photo_similarity_index():
+    return PhotoSimilarityIndex(get_store(PhotoStore))
@@ -7,16 +7,19 @@ from pymongo import ASCENDING, DESCENDING, ReadPreference, UpdateOne
 from pymongo.errors import (
     BulkWriteError,
     ConnectionFailure,
+    OperationFailure,
     ServerSelectionTimeoutError,
 )
 from schematics.contrib.mongo import ObjectIdType
 
+from api.audit import query_auditor
 from api.config import mongo_read_preference
 
 
 class MongoErrorCodes:
     """See: https://github.com/mongodb/mongo/blob/master/src/mongo/base/error_codes.err"""
 
+    IndexOptionsConflict = 85
     DuplicateKey = 11000
 
 
@@ -35,6 +38,7 @@ class StorageMixin:
     role = None
     on_save_defaults = None
     on_update_defaults = None
+    indexes = ()
 
     @backoff.on_exception(
         backoff.expo, (ConnectionFailure, ServerSelectionTimeoutError), max_tries=12
@@ -47,6 +51,34 @@ class StorageMixin:
             read_preference=ALLOWED_MONGO_READ_PREFERENCES[read_preference],
         )
 
+    def ensure_indexes(self):
+        """Create the indexes declared on the store. TTL indexes whose expiry
+        changed are updated in place, Mongo refuses to recreate them."""
+        if not self.indexes:
+            return
+
+        try:
+            self.db.create_indexes(list(self.indexes))
+        except OperationFailure as error:
+            if error.code != MongoErrorCodes.IndexOptionsConflict:
+                raise
+
+            for index in self.indexes:
+                document = index.document
+                if "expireAfterSeconds" in document:
+                    self.db.database.command(
+                        "collMod",
+                        self.db.name,
+                        index={
+                            "keyPattern": document["key"],
+                            "expireAfterSeconds": document["expireAfterSeconds"],
+                        },
+                    )
+            self.db.create_indexes(list(self.indexes))
+
+    def audit(self, where, sort=None):
+        query_auditor.check(self.db, where, sort)
+
     def validate(self, obj):
         self.collection(obj).validate()
 
@@ -123,6 +155,7 @@ class StorageMixin:
         backoff.expo, (ConnectionFailure, ServerSelectionTimeoutError), max_tries=12
     )
     def get(self, where):
+        self.audit(where)
         return self.format_return(self.db.find_one(where))
 
     def build_sort(self, field, order):
@@ -149,6 +182,7 @@ class StorageMixin:
         backoff.expo, (ConnectionFailure, ServerSelectionTimeoutError), max_tries=12
     )
     def find_without_format(self, where, sort=None, limit=50, fields=None, skip=0):
+        self.audit(where, sort)
         query = self.db.find(where, fields)
         query.skip(skip)
 
@@ -171,6 +205,7 @@ class StorageMixin:
     )
     def update(self, where, changes):
         changes = self.apply_hook(changes, self.on_update_defaults)
+        self.audit(where)
         return self.db.update_many(where, {"$set": changes})
 
     @backoff.on_exception(
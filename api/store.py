@@ -1,19 +1,55 @@
-from datetime import datetime
+import math
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
 
+from bson.objectid import ObjectId
 from flask_bcrypt import check_password_hash, generate_password_hash
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel, MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 from api import config
-from api.models import Comment, Like, Photo, User
+from api.models import (
+    Comment,
+    IdempotencyRecord,
+    Like,
+    LikeBucket,
+    MigrationCheckpoint,
+    Photo,
+    RateLimitBucket,
+    TrendingPhoto,
+    User,
+)
+from api.process import per_process
 from api.storage import StorageMixin
 
-mongo_client = MongoClient(config.mongo_uri)
-mongo_db = mongo_client[config.mongo_db]
+
+@per_process
+def get_mongo_client():
+    return MongoClient(config.mongo_uri)
+
+
+def get_mongo_db():
+    return get_mongo_client()[config.mongo_db]
+
+
+@per_process
+def get_stores():
+    return {}
+
+
+def get_store(store_class):
+    stores = get_stores()
+    if store_class not in stores:
+        # constructing a store is cheap, a racing thread may build it twice
+        stores.setdefault(store_class, store_class(get_mongo_db()))
+    return stores[store_class]
 
 
 class UserStore(StorageMixin):
     namespace = "user"
     collection = User
+    indexes = (IndexModel([("email", ASCENDING)]),)
 
     on_save_defaults = {  # type: ignore
         "created_at": datetime.utcnow,
@@ -34,42 +70,653 @@ class UserStore(StorageMixin):
 class PhotoStore(StorageMixin):
     namespace = "photo"
     collection = Photo
+    indexes = (
+        IndexModel([("visible", ASCENDING)]),
+        IndexModel(
+            [("content_hash", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"content_hash": {"$type": "string"}},
+        ),
+        IndexModel(
+            [("_id", ASCENDING), ("perceptual_hash", ASCENDING)],
+            partialFilterExpression={"perceptual_hash": {"$type": "string"}},
+        ),
+        # holds every field user timelines filter, sort and return, so
+        # they are read from the index alone
+        IndexModel(
+            [
+                ("user_id", ASCENDING),
+                ("created_at", DESCENDING),
+                ("_id", DESCENDING),
+                ("visible", ASCENDING),
+                ("URI", ASCENDING),
+            ]
+        ),
+    )
 
     on_save_defaults = {  # type: ignore
         "created_at": datetime.utcnow,
     }
 
+    def get_by_content_hash(self, content_hash):
+        return self.get({"content_hash": content_hash})
+
+    def get_or_save(self, photo):
+        """Save `photo` unless a photo with the same content hash exists.
+        Returns the stored photo and whether it was created."""
+        try:
+            return self.save(photo), True
+        except DuplicateKeyError:
+            return self.get_by_content_hash(photo.content_hash), False
+
     def get_visible_photos(self, offset=0, per_page=10):
         photos = self.find({"visible": True})
         delivery_photos = []
         for photo in photos[offset : offset + per_page]:
-            delivery_photos.append({"id": str(photo._id), "uri": photo.URI})
+            delivery_photos.append(
+                {
+                    "id": str(photo._id),
+                    "uri": photo.URI,
+                    "mime_type": photo.mime_type,
+                    "size": photo.size,
+                    "width": photo.width,
+                    "height": photo.height,
+                    "orientation": photo.orientation,
+                    "placeholder": photo.placeholder,
+                }
+            )
         return len(photos), delivery_photos
 
-    def get_pendent_photos(self):
-        photos = self.find({"visible": False})
-        pendent_photos = []
+    def get_user_photos(self, user_id, include_hidden=False, after=None, per_page=10):
+        """Photos uploaded by `user_id`, newest first. Hidden photos and the
+        visibility of each photo are only included for `include_hidden`.
+        `after` is the cursor returned with the previous page."""
+        where = {"user_id": self._ensure_object_id(user_id)}
+        if not include_hidden:
+            where["visible"] = True
+        if after:
+            created_at, _id = after.rsplit(":", 1)
+            created_at = datetime.fromisoformat(created_at)
+            _id = self._ensure_object_id(_id)
+            where["$or"] = [
+                {"created_at": {"$lt": created_at}},
+                {"created_at": created_at, "_id": {"$lt": _id}},
+            ]
+
+        fields = {"_id": True, "URI": True, "created_at": True}
+        if include_hidden:
+            fields["visible"] = True
+
+        photos = []
+        for photo in self.find_without_format(
+            where,
+            sort=[("created_at", DESCENDING), ("_id", DESCENDING)],
+            limit=per_page,
+            fields=fields,
+        ):
+            delivery_photo = {
+                "id": str(photo["_id"]),
+                "uri": photo["URI"],
+                "created_at": photo["created_at"],
+            }
+            if include_hidden:
+                delivery_photo["visible"] = photo.get("visible", False)
+            photos.append(delivery_photo)
+
+        next_cursor = None
+        if len(photos) == per_page:
+            next_cursor = f"{photos[-1]['created_at'].isoformat()}:{photos[-1]['id']}"
+        return photos, next_cursor
+
+    def iter_pendent_photos(self):
+        photos = self.find_without_format(
+            {"visible": False},
+            limit=None,
+            fields={"URI": True, "perceptual_hash": True},
+        )
         for photo in photos:
-            pendent_photos.append({"id": str(photo._id), "uri": photo.URI})
-        return pendent_photos
+            yield {
+                "id": str(photo["_id"]),
+                "uri": photo["URI"],
+                "perceptual_hash": photo.get("perceptual_hash"),
+            }
+
+    def get_pendent_photos(self):
+        return list(self.iter_pendent_photos())
 
     def authorized(self, photo_id):
         self.update_by_id(photo_id, {"visible": True})
 
+    @property
+    def trending_store(self):
+        if getattr(self, "_trending_store", None) is None:
+            self._trending_store = TrendingStore(self.db.database)
+        return self._trending_store
+
+    def get_trending_photos(self, after=None, per_page=10):
+        """Page through the materialized trending ranking, `after` being the
+        cursor returned with the previous page."""
+        return self.trending_store.get_page(after, per_page)
+
 
 class CommentStore(StorageMixin):
     namespace = "comment"
     collection = Comment
+    indexes = (
+        IndexModel([("created_at", ASCENDING)]),
+        IndexModel([("photo_id", ASCENDING)]),
+        IndexModel([("text", TEXT)]),
+    )
 
     on_save_defaults = {  # type: ignore
         "created_at": datetime.utcnow,
     }
 
+    def set_photo_visible(self, photo_id, visible=True):
+        self.update(
+            {"photo_id": self._ensure_object_id(photo_id)}, {"photo_visible": visible}
+        )
+
+    def search(self, query, photo_id=None, visible=None, after=None, per_page=20):
+        """Comments matching `query` on the text index, best match first,
+        with their relevance score. `after` is the cursor returned with the
+        previous page."""
+        match = {"$text": {"$search": query}}
+        if photo_id is not None:
+            match["photo_id"] = self._ensure_object_id(photo_id)
+        if visible is not None:
+            match["photo_visible"] = visible
+
+        pipeline = [
+            {"$match": match},
+            {
+                "$project": {
+                    "photo_id": True,
+                    "user_id": True,
+                    "text": True,
+                    "photo_visible": True,
+                    "created_at": True,
+                    "score": {"$meta": "textScore"},
+                }
+            },
+        ]
+        if after:
+            score, _id = after.rsplit(":", 1)
+            score, _id = float(score), self._ensure_object_id(_id)
+            pipeline.append(
+                {
+                    "$match": {
+                        "$or": [
+                            {"score": {"$lt": score}},
+                            {"score": score, "_id": {"$lt": _id}},
+                        ]
+                    }
+                }
+            )
+        pipeline += [
+            {"$sort": {"score": DESCENDING, "_id": DESCENDING}},
+            {"$limit": per_page},
+        ]
+
+        comments = [
+            {
+                "id": str(comment["_id"]),
+                "photo_id": str(comment["photo_id"]),
+                "user_id": str(comment["user_id"]),
+                "text": comment["text"],
+                "photo_visible": comment.get("photo_visible", False),
+                "created_at": comment.get("created_at"),
+                "score": comment["score"],
+            }
+            for comment in self.db.aggregate(pipeline)
+        ]
+
+        next_cursor = None
+        if len(comments) == per_page:
+            next_cursor = f"{comments[-1]['score']!r}:{comments[-1]['id']}"
+        return comments, next_cursor
+
+    def engagement_pipeline(self, since):
+        return [
+            {"$match": {"created_at": {"$gte": since}}},
+            {"$project": {"photo_id": True, "created_at": True}},
+        ]
+
 
 class LikeStore(StorageMixin):
     namespace = "like"
     collection = Like
+    indexes = (
+        IndexModel([("created_at", ASCENDING)]),
+        IndexModel([("photo_id", ASCENDING), ("created_at", ASCENDING)]),
+    )
 
     on_save_defaults = {  # type: ignore
         "created_at": datetime.utcnow,
     }
+
+    def count_by_photo(self, photo_id):
+        where = {"photo_id": self._ensure_object_id(photo_id)}
+        self.audit(where)
+        return self.db.count_documents(where)
+
+    def engagement_pipeline(self, since):
+        return [
+            {"$match": {"created_at": {"$gte": since}}},
+            {"$project": {"photo_id": True, "created_at": True}},
+        ]
+
+
+class LikeBucketStore(StorageMixin):
+    """Compact storage for likes, grouping the likes of a photo into bucket
+    documents of up to `bucket_size` likes instead of one document each.
+    Saving a like a user already gave to the photo returns the stored one."""
+
+    namespace = "like_bucket"
+    collection = LikeBucket
+    indexes = (
+        IndexModel([("photo_id", ASCENDING), ("count", ASCENDING)]),
+        # unique across buckets, `push` keeps a user once within a bucket
+        IndexModel(
+            [("photo_id", ASCENDING), ("likes.user_id", ASCENDING)], unique=True
+        ),
+        IndexModel([("updated_at", ASCENDING)]),
+    )
+    bucket_size = config.like_bucket_size
+
+    def get_like(self, photo_id, user_id):
+        photo_id = self._ensure_object_id(photo_id)
+        user_id = self._ensure_object_id(user_id)
+        where = {"photo_id": photo_id, "likes.user_id": user_id}
+        self.audit(where)
+        bucket = self.db.find_one(where, {"likes.$": True})
+        if bucket is None:
+            return None
+        return Like(dict(bucket["likes"][0], photo_id=photo_id))
+
+    def save(self, like, apply_hook=True):
+        if not isinstance(like, Like):
+            like = Like(like)
+        if apply_hook:
+            like.created_at = datetime.utcnow()
+        like.validate()
+
+        existing = self.get_like(like.photo_id, like.user_id)
+        if existing is not None:
+            return existing
+
+        try:
+            self.push(like)
+        except DuplicateKeyError:
+            # a concurrent request stored the like of this user first
+            return self.get_like(like.photo_id, like.user_id)
+        return like
+
+    def push(self, like):
+        """Add `like` to a bucket of the photo with room left, creating one
+        when there is none. Raises DuplicateKeyError when the user already
+        liked the photo."""
+        where = {
+            "photo_id": self._ensure_object_id(like.photo_id),
+            "count": {"$lt": self.bucket_size},
+            "likes.user_id": {"$ne": self._ensure_object_id(like.user_id)},
+        }
+        self.audit(where)
+        self.db.update_one(
+            where,
+            {
+                "$push": {"likes": self.to_entry(like)},
+                "$inc": {"count": 1},
+                "$set": {"updated_at": datetime.utcnow()},
+                "$setOnInsert": {"created_at": datetime.utcnow()},
+            },
+            upsert=True,
+        )
+
+    def to_entry(self, like):
+        return {
+            "_id": self._ensure_object_id(like["_id"]),
+            "user_id": self._ensure_object_id(like["user_id"]),
+            "created_at": like.get("created_at"),
+        }
+
+    def count_by_photo(self, photo_id):
+        where = {"photo_id": self._ensure_object_id(photo_id)}
+        self.audit(where)
+        result = list(
+            self.db.aggregate(
+                [
+                    {"$match": where},
+                    {"$group": {"_id": None, "count": {"$sum": "$count"}}},
+                ]
+            )
+        )
+        return result[0]["count"] if result else 0
+
+    def engagement_pipeline(self, since):
+        return [
+            {"$match": {"updated_at": {"$gte": since}}},
+            {"$unwind": "$likes"},
+            {"$match": {"likes.created_at": {"$gte": since}}},
+            {"$project": {"photo_id": True, "created_at": "$likes.created_at"}},
+        ]
+
+    def get_user_ids(self, photo_id):
+        buckets = self.find_without_format(
+            {"photo_id": photo_id}, limit=None, fields={"likes.user_id": True}
+        )
+        return {like["user_id"] for bucket in buckets for like in bucket["likes"]}
+
+    def insert_bucket(self, photo_id, entries):
+        now = datetime.utcnow()
+        self.db.insert_one(
+            {
+                "_id": ObjectId(),
+                "photo_id": photo_id,
+                "count": len(entries),
+                "likes": entries,
+                "created_at": now,
+                "updated_at": now,
+            }
+        )
+
+    def migrate_from(self, like_store):
+        """Copy the likes stored one document per like into buckets. Likes of
+        users already in a bucket of the photo are skipped, so an interrupted
+        migration can be run again. Returns the number of likes copied."""
+        likes = like_store.find_without_format(
+            {},
+            sort=[("photo_id", ASCENDING), ("created_at", ASCENDING)],
+            limit=None,
+        )
+
+        migrated = 0
+        for photo_id, photo_likes in groupby(likes, key=itemgetter("photo_id")):
+            user_ids = self.get_user_ids(photo_id)
+            entries = []
+            for like in photo_likes:
+                if like["user_id"] in user_ids:
+                    continue
+                user_ids.add(like["user_id"])
+                entries.append(self.to_entry(like))
+
+                if len(entries) == self.bucket_size:
+                    self.insert_bucket(photo_id, entries)
+                    migrated, entries = migrated + len(entries), []
+
+            if entries:
+                self.insert_bucket(photo_id, entries)
+                migrated += len(entries)
+
+        return migrated
+
+
+class TrendingStore(StorageMixin):
+    """Photos ranked by time-decayed engagement, materialized by `refresh`
+    so that reading a page of the ranking costs one index range scan."""
+
+    namespace = "photo_trending"
+    collection = TrendingPhoto
+    indexes = (
+        IndexModel(
+            [("visible", ASCENDING), ("score", DESCENDING), ("_id", DESCENDING)]
+        ),
+        IndexModel([("refreshed_at", ASCENDING)]),
+    )
+
+    score_weights = {"like_score": 1, "comment_score": 2}
+
+    def get_page(self, after=None, per_page=10):
+        where = {"visible": True}
+        if after:
+            score, _id = after.rsplit(":", 1)
+            score, _id = float(score), self._ensure_object_id(_id)
+            where["$or"] = [
+                {"score": {"$lt": score}},
+                {"score": score, "_id": {"$lt": _id}},
+            ]
+
+        photos = [
+            {"id": str(photo["_id"]), "uri": photo["URI"], "score": photo["score"]}
+            for photo in self.find_without_format(
+                where,
+                sort=[("score", DESCENDING), ("_id", DESCENDING)],
+                limit=per_page,
+                fields={"URI": True, "score": True},
+            )
+        ]
+
+        next_cursor = None
+        if len(photos) == per_page:
+            next_cursor = f"{photos[-1]['score']!r}:{photos[-1]['id']}"
+        return photos, next_cursor
+
+    def refresh(self, like_store, comment_store, now=None):
+        """Recompute the scores of the photos engaged with in the trending
+        window and `$merge` them into the ranking. Photos without recent
+        engagement are dropped from it."""
+        now = now or datetime.utcnow()
+        since = now - timedelta(hours=config.trending_window_hours)
+        for store, field in (
+            (like_store, "like_score"),
+            (comment_store, "comment_score"),
+        ):
+            store.db.aggregate(
+                store.engagement_pipeline(since) + self.merge_pipeline(field, now)
+            )
+
+        self.db.delete_many({"refreshed_at": {"$lt": now}})
+
+    def merge_pipeline(self, field, now):
+        decay = math.log(2) / (config.trending_half_life_hours * 3600)
+        age_seconds = {"$divide": [{"$subtract": [now, "$created_at"]}, 1000]}
+        other_fields = [name for name in self.score_weights if name != field]
+
+        # a field not refreshed by this run is left over from a previous one
+        fresh_fields = {
+            name: {
+                "$cond": [
+                    {"$eq": ["$refreshed_at", "$$new.refreshed_at"]},
+                    f"${name}",
+                    0,
+                ]
+            }
+            for name in other_fields
+        }
+        score = {
+            "$add": [
+                {"$multiply": [f"${name}", weight]}
+                for name, weight in self.score_weights.items()
+            ]
+        }
+
+        return [
+            {
+                "$group": {
+                    "_id": "$photo_id",
+                    field: {"$sum": {"$exp": {"$multiply": [-decay, age_seconds]}}},
+                }
+            },
+            {
+                "$lookup": {
+                    "from": PhotoStore.namespace,
+                    "localField": "_id",
+                    "foreignField": "_id",
+                    "as": "photo",
+                }
+            },
+            {"$unwind": "$photo"},
+            {
+                "$project": {
+                    "URI": "$photo.URI",
+                    "visible": {"$ifNull": ["$photo.visible", False]},
+                    "refreshed_at": {"$literal": now},
+                    field: True,
+                    **{name: {"$literal": 0} for name in other_fields},
+                }
+            },
+            {"$set": {"score": score}},
+            {
+                "$merge": {
+                    "into": self.namespace,
+                    "on": "_id",
+                    "whenMatched": [
+                        {
+                            "$set": {
+                                **fresh_fields,
+                                field: f"$$new.{field}",
+                                "URI": "$$new.URI",
+                                "visible": "$$new.visible",
+                                "refreshed_at": "$$new.refreshed_at",
+                            }
+                        },
+                        {"$set": {"score": score}},
+                    ],
+                    "whenNotMatched": "insert",
+                }
+            },
+        ]
+
+
+class IdempotencyStore(StorageMixin):
+    namespace = "idempotency_key"
+    collection = IdempotencyRecord
+    indexes = (
+        IndexModel([("user_id", ASCENDING), ("key", ASCENDING)], unique=True),
+        IndexModel(
+            [("created_at", ASCENDING)], expireAfterSeconds=config.idempotency_ttl
+        ),
+    )
+
+    on_save_defaults = {  # type: ignore
+        "created_at": datetime.utcnow,
+    }
+
+    def get_by_key(self, user_id, key):
+        return self.get({"user_id": self._ensure_object_id(user_id), "key": key})
+
+    def start(self, user_id, key, endpoint):
+        """Claim `key` for a request of `user_id`. Returns the record and
+        whether the caller owns it and has to run the request. A pending
+        record left behind for longer than the lock timeout is taken over."""
+        record = IdempotencyRecord(
+            {"_id": ObjectId(), "user_id": user_id, "key": key, "endpoint": endpoint}
+        )
+        try:
+            return self.save(record), True
+        except DuplicateKeyError:
+            record = self.get_by_key(user_id, key)
+
+        stale_at = datetime.utcnow() - timedelta(
+            seconds=config.idempotency_lock_timeout
+        )
+        if record.status == "pending" and record.created_at < stale_at:
+            result = self.db.update_one(
+                {
+                    "_id": record._id,
+                    "status": "pending",
+                    "created_at": record.created_at,
+                },
+                {"$set": {"created_at": datetime.utcnow()}},
+            )
+            return record, result.modified_count == 1
+        return record, False
+
+    def complete(self, record_id, response_status, response_body):
+        self.update_by_id(
+            record_id,
+            {
+                "status": "completed",
+                "response_status": response_status,
+                "response_body": response_body,
+            },
+        )
+
+    def discard(self, record_id):
+        self.db.delete_one({"_id": self._ensure_object_id(record_id)})
+
+
+class MigrationStore(StorageMixin):
+    namespace = "migration"
+    collection = MigrationCheckpoint
+    indexes = (IndexModel([("migration", ASCENDING), ("_id", ASCENDING)]),)
+
+    on_update_defaults = {  # type: ignore
+        "updated_at": datetime.utcnow,
+    }
+
+    def get_checkpoints(self, migration):
+        return self.find({"migration": migration}, sort=[("_id", ASCENDING)])
+
+
+class RateLimitStore(StorageMixin):
+    namespace = "rate_limit"
+    collection = RateLimitBucket
+    indexes = (
+        IndexModel(
+            [("updated_at", ASCENDING)], expireAfterSeconds=config.rate_limit_ttl
+        ),
+    )
+
+    def consume(self, key, capacity, refill_rate):
+        """Take one token from the bucket `key` in a single atomic update,
+        refilling it from the time elapsed on the server clock.
+        Returns whether a token was available and how many tokens are left."""
+        elapsed = {
+            "$divide": [
+                {"$subtract": ["$$NOW", {"$ifNull": ["$updated_at", "$$NOW"]}]},
+                1000,
+            ]
+        }
+        refilled = {
+            "$add": [
+                {"$ifNull": ["$tokens", capacity]},
+                {"$multiply": [elapsed, refill_rate]},
+            ]
+        }
+        bucket = self.db.find_one_and_update(
+            {"_id": key},
+            [
+                {
+                    "$set": {
+                        "tokens": {"$min": [capacity, refilled]},
+                        "updated_at": "$$NOW",
+                    }
+                },
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {
+                    "$set": {
+                        "tokens": {
+                            "$cond": [
+                                "$allowed",
+                                {"$subtract": ["$tokens", 1]},
+                                "$tokens",
+                            ]
+                        }
+                    }
+                },
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return bucket["allowed"], bucket["tokens"]
+
+
+STORES = (
+    UserStore,
+    PhotoStore,
+    CommentStore,
+    LikeStore,
+    LikeBucketStore,
+    TrendingStore,
+    IdempotencyStore,
+    MigrationStore,
+    RateLimitStore,
+)
+
+
+def ensure_indexes(db):
+    """Create the indexes of every store. Run by `flask ensure-indexes` on
+    deploy, never while serving requests since builds can take long."""
+    for store_class in STORES:
+        store_class(db).ensure_indexes()
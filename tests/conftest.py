@@ -5,8 +5,11 @@ from pymongo import MongoClient
 
 from api import app as app_api
 from api import config
+from api.audit import query_auditor
 from api.models import User
-from api.store import UserStore
+from api.ratelimit import rate_limiter
+from api.similarity import get_photo_similarity_index
+from api.store import UserStore, ensure_indexes
 
 
 @pytest.fixture
@@ -14,16 +17,27 @@ def mongo_db(request):
     def setup():
         mongo_client = MongoClient(config.mongo_uri)
         request.addfinalizer(lambda: mongo_client.drop_database(config.mongo_db))
-        return mongo_client[config.mongo_db]
+        db = mongo_client[config.mongo_db]
+        ensure_indexes(db)
+        return db
 
     return setup
 
 
+@pytest.fixture(autouse=True)
+def query_audit():
+    query_auditor.mode = "raise"
+    yield
+    query_auditor.mode = config.query_audit
+
+
 @pytest.fixture
 def app():
     app_api.flask_app.config["TESTING"] = True
     app_api.flask_app.config["SERVER_NAME"] = "test."
     app_api.flask_app.config["DEBUG"] = True
+    rate_limiter.reset()
+    get_photo_similarity_index.reset()
     return app_api.flask_app
 
 
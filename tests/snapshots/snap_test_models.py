@@ -10,6 +10,7 @@ snapshots['test_comment_model 1'] = {
     '_id': None,
     'created_at': None,
     'photo_id': None,
+    'photo_visible': False,
     'text': 'comment test',
     'user_id': None
 }
@@ -24,9 +25,17 @@ snapshots['test_like_model 1'] = {
 snapshots['test_photo_model 1'] = {
     'URI': 's3://photoview/test.png',
     '_id': None,
+    'content_hash': None,
     'created_at': None,
+    'height': None,
+    'mime_type': None,
+    'orientation': None,
+    'perceptual_hash': None,
+    'placeholder': None,
+    'size': None,
     'user_id': None,
-    'visible': False
+    'visible': False,
+    'width': None
 }
 
 snapshots['test_user_model 1'] = {
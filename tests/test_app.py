@@ -1,10 +1,20 @@
 import io
+import threading
 from unittest import mock
 
 from bson.objectid import ObjectId
 
-from api.models import Photo, User
-from api.store import PhotoStore, UserStore
+from api import config
+from api.events import PhotoEventBroker
+from api.models import Comment, Photo, User
+from api.ratelimit import concurrency_limiter, parse_rate, rate_limiter
+from api.store import (
+    CommentStore,
+    IdempotencyStore,
+    LikeBucketStore,
+    PhotoStore,
+    UserStore,
+)
 
 
 def test_api_signup(client, mongo_db):
@@ -54,6 +64,29 @@ def test_api_create_photo(get_s3_bucket_mocked, user_admin_token, client, mongo_
     photo_id = response.json["body"]["photo_id"]
     photo = photo_store.get_by_id(photo_id)
     assert photo.URI == "s3://bucket/file.jpg"
+    assert photo.size == 6
+    assert photo.width is None
+
+
+@mock.patch("api.app.get_s3_uri")
+def test_api_create_photo_duplicate(
+    get_s3_uri_mocked, user_admin_token, client, mongo_db
+):
+    photo_store = PhotoStore(mongo_db())
+
+    get_s3_uri_mocked.return_value = "s3://bucket/file.jpg"
+    headers = {"Authorization": f"Bearer {user_admin_token}"}
+    data = {"file": (io.BytesIO(b"abcdef"), "test.jpg")}
+    response = client.post("/photos", data=data, headers=headers)
+    assert response.status_code == 201
+    photo_id = response.json["body"]["photo_id"]
+
+    data = {"file": (io.BytesIO(b"abcdef"), "copy.jpg")}
+    response = client.post("/photos", data=data, headers=headers)
+    assert response.status_code == 200
+    assert response.json["body"]["photo_id"] == photo_id
+    assert get_s3_uri_mocked.call_count == 1
+    assert len(photo_store.find({"visible": False})) == 1
 
 
 def test_api_create_photo_user_invalid(user_simple_token, client, mongo_db):
@@ -96,6 +129,69 @@ def test_api_get_gallery(user_simple, user_simple_token, client, mongo_db):
     assert response.json["photos"][0]["uri"] == second_photo["URI"]
 
 
+def test_api_get_photos_trending_per_page(user_simple_token, client, mongo_db):
+    headers = {"Authorization": f"Bearer {user_simple_token}"}
+
+    response = client.get("/photos/trending?per_page=0", headers=headers)
+    assert response.status_code == 200
+    assert response.json["per_page"] == 1
+
+    response = client.get("/photos/trending?per_page=many", headers=headers)
+    assert response.status_code == 400
+
+
+def test_api_get_user_photos(
+    user_simple, user_simple_token, user_admin, user_admin_token, client, mongo_db
+):
+    photo_store = PhotoStore(mongo_db())
+    for visible in (True, False):
+        photo_store.save(
+            Photo(
+                {
+                    "_id": ObjectId(),
+                    "URI": f"s3://photoview/{visible}.png",
+                    "user_id": user_simple._id,
+                    "visible": visible,
+                }
+            )
+        )
+
+    response = client.get(
+        f"/users/{user_simple._id}/photos",
+        headers={"Authorization": f"Bearer {user_simple_token}"},
+    )
+    assert response.status_code == 200
+    assert [photo["visible"] for photo in response.json["photos"]] == [False, True]
+
+    response = client.get(
+        f"/users/{user_simple._id}/photos",
+        headers={"Authorization": f"Bearer {user_admin_token}"},
+    )
+    assert response.status_code == 200
+    assert len(response.json["photos"]) == 1
+    assert "visible" not in response.json["photos"][0]
+
+    response = client.get(
+        "/users/invalid/photos",
+        headers={"Authorization": f"Bearer {user_admin_token}"},
+    )
+    assert response.status_code == 400
+
+    response = client.get(
+        f"/users/{user_simple._id}/photos?per_page=0",
+        headers={"Authorization": f"Bearer {user_simple_token}"},
+    )
+    assert response.status_code == 200
+    assert len(response.json["photos"]) == 1
+    assert response.json["next"] is not None
+
+    response = client.get(
+        f"/users/{user_simple._id}/photos?per_page=many",
+        headers={"Authorization": f"Bearer {user_simple_token}"},
+    )
+    assert response.status_code == 400
+
+
 def test_api_get_photos_pendent(user_admin, user_admin_token, client, mongo_db):
     photo_store = PhotoStore(mongo_db())
 
@@ -129,6 +225,39 @@ def test_api_get_photos_pendent(user_admin, user_admin_token, client, mongo_db):
     assert response.json["photos"][0]["uri"] == first_photo["URI"]
 
 
+def test_api_get_photos_pendent_near_duplicates(
+    user_admin, user_admin_token, client, mongo_db
+):
+    photo_store = PhotoStore(mongo_db())
+    photos = []
+    for perceptual_hash in ("ffff0000ffff0000", "ffff0000ffff0003"):
+        photo = Photo(
+            {
+                "_id": ObjectId(),
+                "URI": f"s3://photoview/{perceptual_hash}.png",
+                "user_id": user_admin._id,
+                "perceptual_hash": perceptual_hash,
+            }
+        )
+        photos.append(photo_store.save(photo))
+
+    headers = {"Authorization": f"Bearer {user_admin_token}"}
+    response = client.get("/photos/pendent", headers=headers)
+    assert response.status_code == 200
+    near_duplicates = {
+        photo["id"]: photo["near_duplicates"] for photo in response.json["photos"]
+    }
+    assert near_duplicates[str(photos[0]._id)] == [
+        {"id": str(photos[1]._id), "distance": 2}
+    ]
+
+    response = client.get(
+        f"/photos/{photos[1]._id}/similar?max_distance=1", headers=headers
+    )
+    assert response.status_code == 200
+    assert response.json == {"photos": []}
+
+
 def test_api_photo_pendent_user_not_admin(
     user_simple, user_simple_token, client, mongo_db
 ):
@@ -156,6 +285,18 @@ def test_api_photo_pendent_user_not_admin(
     assert response.status_code == 403
 
 
+@mock.patch("api.app.get_photo_event_broker")
+def test_api_photo_events_too_many_subscribers(
+    get_photo_event_broker_mocked, user_simple_token, client, mongo_db
+):
+    get_photo_event_broker_mocked.return_value = PhotoEventBroker(max_subscribers=0)
+    headers = {"Authorization": f"Bearer {user_simple_token}"}
+
+    response = client.get("/photos/events", headers=headers)
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) > 0
+
+
 def test_api_photo_authorized(user_admin, user_admin_token, client, mongo_db):
     photo_store = PhotoStore(mongo_db())
 
@@ -236,6 +377,22 @@ def test_api_photo_liked(user_simple, user_simple_token, client, mongo_db):
     assert response.status_code == 200
 
 
+def test_api_photo_liked_bucket_storage(
+    user_simple_token, client, mongo_db, monkeypatch
+):
+    monkeypatch.setattr(config, "like_storage", "bucket")
+    photo_id = ObjectId()
+    headers = {"Authorization": f"Bearer {user_simple_token}"}
+
+    response = client.post(f"/photos/{photo_id}/liked", headers=headers)
+    assert response.status_code == 200
+
+    repeated = client.post(f"/photos/{photo_id}/liked", headers=headers)
+    assert repeated.status_code == 200
+    assert repeated.json["_id"] == response.json["_id"]
+    assert LikeBucketStore(mongo_db()).count_by_photo(photo_id) == 1
+
+
 def test_api_photo_comment(user_simple, user_simple_token, client, mongo_db):
     photo_store = PhotoStore(mongo_db())
 
@@ -261,3 +418,106 @@ def test_api_photo_comment(user_simple, user_simple_token, client, mongo_db):
         f"/photos/{first_photo._id}/comment", json=data, headers=headers
     )
     assert response.status_code == 200
+
+
+def test_api_search_comments(user_admin, user_admin_token, client, mongo_db):
+    comment_store = CommentStore(mongo_db())
+    comment_store.save(
+        Comment(
+            {
+                "_id": ObjectId(),
+                "photo_id": ObjectId(),
+                "user_id": user_admin._id,
+                "text": "abusive comment",
+            }
+        )
+    )
+
+    headers = {"Authorization": f"Bearer {user_admin_token}"}
+    response = client.get("/comments/search?q=abusive", headers=headers)
+    assert response.status_code == 200
+    assert len(response.json["comments"]) == 1
+    assert response.json["comments"][0]["text"] == "abusive comment"
+    assert response.json["comments"][0]["score"] > 0
+
+    response = client.get("/comments/search?q=abusive&per_page=0", headers=headers)
+    assert response.status_code == 200
+    assert response.json["per_page"] == 1
+
+    response = client.get("/comments/search?q=abusive&per_page=-5", headers=headers)
+    assert response.status_code == 200
+
+    response = client.get("/comments/search?q=abusive&per_page=x", headers=headers)
+    assert response.status_code == 400
+
+
+def test_api_search_comments_user_not_admin(user_simple_token, client, mongo_db):
+    headers = {"Authorization": f"Bearer {user_simple_token}"}
+    response = client.get("/comments/search?q=abusive", headers=headers)
+    assert response.status_code == 403
+
+
+def test_api_photo_comment_idempotency_key(
+    user_simple, user_simple_token, client, mongo_db
+):
+    comment_store = CommentStore(mongo_db())
+    photo_id = ObjectId()
+
+    headers = {
+        "Authorization": f"Bearer {user_simple_token}",
+        "Idempotency-Key": "comment-1",
+    }
+    data = {"text": "test text"}
+    response = client.post(f"/photos/{photo_id}/comment", json=data, headers=headers)
+    assert response.status_code == 200
+
+    retry = client.post(f"/photos/{photo_id}/comment", json=data, headers=headers)
+    assert retry.status_code == 200
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json == response.json
+    assert len(comment_store.find({"photo_id": photo_id})) == 1
+
+    response = client.post(f"/photos/{photo_id}/liked", headers=headers)
+    assert response.status_code == 422
+
+
+def test_api_photo_liked_idempotency_key_rate_limited(
+    user_simple, user_simple_token, client, mongo_db
+):
+    photo_id = ObjectId()
+    headers = {"Authorization": f"Bearer {user_simple_token}"}
+    capacity, _ = parse_rate(config.rate_limit_write)
+    for _ in range(capacity):
+        response = client.post(f"/photos/{ObjectId()}/liked", headers=headers)
+        assert response.status_code == 200
+
+    headers["Idempotency-Key"] = "like-1"
+    response = client.post(f"/photos/{photo_id}/liked", headers=headers)
+    assert response.status_code == 429
+
+    # the bucket refilled, the retry runs instead of replaying the 429
+    rate_limiter.reset()
+    retry = client.post(f"/photos/{photo_id}/liked", headers=headers)
+    assert retry.status_code == 200
+    assert "Idempotent-Replayed" not in retry.headers
+
+
+def test_api_photo_liked_idempotency_key_waits_without_slot(
+    user_simple, user_simple_token, client, mongo_db, monkeypatch
+):
+    photo_id = ObjectId()
+    IdempotencyStore(mongo_db()).start(
+        user_simple._id, "like-1", f"POST /photos/{photo_id}/liked"
+    )
+    monkeypatch.setattr(config, "idempotency_wait", 0)
+    # every concurrency slot of the worker is taken
+    semaphore = threading.BoundedSemaphore(1)
+    semaphore.acquire()
+    monkeypatch.setattr(concurrency_limiter, "semaphore", semaphore)
+
+    headers = {
+        "Authorization": f"Bearer {user_simple_token}",
+        "Idempotency-Key": "like-1",
+    }
+    response = client.post(f"/photos/{photo_id}/liked", headers=headers)
+    assert response.status_code == 409
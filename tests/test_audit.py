@@ -0,0 +1,38 @@
+import pytest
+from bson.objectid import ObjectId
+
+from api.audit import QueryAuditor, UnindexedQueryError, query_shape
+from api.store import CommentStore, PhotoStore
+
+
+def test_query_shape_ignores_values():
+    first = query_shape({"_id": ObjectId(), "visible": {"$in": [True, False]}})
+    second = query_shape({"visible": {"$in": [False, True]}, "_id": ObjectId()})
+    assert first == second
+    assert first != query_shape({"_id": "not an object id"})
+
+
+def test_query_auditor_inspect():
+    auditor = QueryAuditor("raise", max_examined_ratio=10)
+    explain = {
+        "queryPlanner": {
+            "winningPlan": {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}
+        },
+        "executionStats": {"nReturned": 1, "totalDocsExamined": 100},
+    }
+    assert auditor.inspect(explain) == [
+        "collection scan",
+        "in-memory sort",
+        "examined 100 documents for 1 returned",
+    ]
+
+
+def test_query_auditor_indexed_query(mongo_db):
+    photo_store = PhotoStore(mongo_db())
+    assert photo_store.find({"visible": True}) == ()
+
+
+def test_query_auditor_unindexed_query(mongo_db):
+    comment_store = CommentStore(mongo_db())
+    with pytest.raises(UnindexedQueryError):
+        comment_store.find({"text": "comment test"})
@@ -0,0 +1,45 @@
+import json
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+from api.encoders import OrjsonEncoder, dumps, stream_json_list
+
+
+def test_dumps_object_id_and_datetime():
+    _id = ObjectId()
+    created_at = datetime(2021, 1, 2, 3, 4, 5)
+    assert json.loads(dumps({"_id": _id, "created_at": created_at})) == {
+        "_id": str(_id),
+        "created_at": "2021-01-02T03:04:05",
+    }
+
+
+def test_orjson_encoder_ignores_formatting_arguments():
+    encoded = json.dumps({"a": 1}, cls=OrjsonEncoder, indent=2, sort_keys=True)
+    assert encoded == '{"a":1}'
+
+
+def test_jsonify_uses_orjson_encoder(app):
+    _id = ObjectId()
+    with app.app_context():
+        response = app.make_response({"_id": _id})
+    assert response.json == {"_id": str(_id)}
+
+
+def test_stream_json_list(app):
+    items = ({"id": index} for index in range(250))
+    with app.test_request_context():
+        response = stream_json_list("photos", items, total=250)
+        body = b"".join(response.response)
+    assert json.loads(body) == {
+        "total": 250,
+        "photos": [{"id": index} for index in range(250)],
+    }
+
+
+def test_stream_json_list_empty(app):
+    with app.test_request_context():
+        response = stream_json_list("photos", iter(()))
+        body = b"".join(response.response)
+    assert json.loads(body) == {"photos": []}
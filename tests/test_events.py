@@ -0,0 +1,134 @@
+import pytest
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure
+
+from api import events
+from api.events import (
+    CHANGE_STREAM_HISTORY_LOST,
+    RESET_EVENT,
+    PhotoChangeWatcher,
+    PhotoEventBroker,
+    TooManySubscribers,
+    change_to_event,
+    format_event,
+    stream_photo_events,
+)
+
+
+def make_event(event_id, visible=True):
+    return {
+        "id": event_id,
+        "type": "photo.visible",
+        "photo": {"id": event_id, "uri": "s3://photoview/test.png", "visible": visible},
+    }
+
+
+def test_change_to_event():
+    photo_id = ObjectId()
+    change = {
+        "_id": {"_data": "token"},
+        "operationType": "insert",
+        "fullDocument": {"_id": photo_id, "URI": "s3://photoview/test.png"},
+    }
+    assert change_to_event(change) == {
+        "id": "token",
+        "type": "photo.created",
+        "photo": {
+            "id": str(photo_id),
+            "uri": "s3://photoview/test.png",
+            "visible": False,
+        },
+    }
+
+
+def test_format_event():
+    assert format_event(make_event("1")) == (
+        "id: 1\nevent: photo.visible\n"
+        'data: {"type":"photo.visible","photo":'
+        '{"id":"1","uri":"s3://photoview/test.png","visible":true}}\n\n'
+    )
+
+
+def test_broker_fans_out_to_subscribers():
+    broker = PhotoEventBroker()
+    first = broker.subscribe()
+    second = broker.subscribe()
+
+    broker.publish(make_event("1"))
+    assert first.queue.get_nowait()["id"] == "1"
+    assert second.queue.get_nowait()["id"] == "1"
+
+
+def test_broker_caps_subscribers():
+    broker = PhotoEventBroker(max_subscribers=1)
+    subscription = broker.subscribe()
+    with pytest.raises(TooManySubscribers):
+        broker.subscribe()
+
+    broker.unsubscribe(subscription)
+    assert broker.subscribe() is not None
+
+
+def test_broker_replays_after_last_event_id():
+    broker = PhotoEventBroker(history_size=2)
+    for event_id in ("1", "2", "3"):
+        broker.publish(make_event(event_id))
+
+    subscription = broker.subscribe("2")
+    assert [event["id"] for event in subscription.backlog] == ["3"]
+
+    subscription = broker.subscribe("1")
+    assert subscription.backlog is None
+
+
+def test_stream_photo_events_filters_hidden_photos():
+    broker = PhotoEventBroker()
+    broker.publish(make_event("1", visible=False))
+    broker.publish(make_event("2"))
+    broker.publish(make_event("3"))
+
+    subscription = broker.subscribe("1")
+    subscription.active = False
+    events = list(stream_photo_events(broker, subscription))
+    assert events == [format_event(make_event("2")), format_event(make_event("3"))]
+    assert subscription not in broker.subscribers
+
+
+def test_stream_photo_events_reset():
+    broker = PhotoEventBroker()
+    subscription = broker.subscribe("unknown")
+    subscription.active = False
+    assert list(stream_photo_events(broker, subscription, admin=True)) == [
+        "event: reset\ndata: {}\n\n"
+    ]
+
+
+class StopWatching(BaseException):
+    pass
+
+
+def test_photo_change_watcher_recovers(monkeypatch):
+    monkeypatch.setattr(events.time, "sleep", lambda seconds: None)
+    broker = PhotoEventBroker()
+    broker.publish(make_event("1"))
+    subscription = broker.subscribe()
+    watcher = PhotoChangeWatcher(broker)
+    watcher.resume_token = {"_data": "expired"}
+
+    errors = [
+        OperationFailure("history lost", code=CHANGE_STREAM_HISTORY_LOST),
+        KeyError("URI"),
+        StopWatching(),
+    ]
+
+    def watch():
+        raise errors.pop(0)
+
+    watcher.watch = watch
+    with pytest.raises(StopWatching):
+        watcher.run()
+
+    assert watcher.resume_token is None
+    assert broker.history == []
+    assert subscription.queue.get_nowait() is RESET_EVENT
+    assert broker.subscribe("1").backlog is None
@@ -0,0 +1,106 @@
+import io
+import os
+
+import pytest
+
+from api import files
+from api.files import LocalFileBackend, LRUFileCache
+
+
+@pytest.fixture
+def local_backend(tmp_path, monkeypatch):
+    backend = LocalFileBackend(str(tmp_path / "media"), "/files")
+    monkeypatch.setattr(files.get_file_backend, "value", backend)
+    return backend
+
+
+def test_local_file_backend(local_backend):
+    uri = local_backend.save("abc.jpg", io.BytesIO(b"abcdef"))
+    assert uri == "/files/abc.jpg"
+
+    path = local_backend.get_path("abc.jpg")
+    with open(path, "rb") as fileobj:
+        assert fileobj.read() == b"abcdef"
+
+    assert local_backend.get_path("missing.jpg") is None
+    assert local_backend.get_path("../abc.jpg") is None
+
+
+def test_local_file_backend_relative_root(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    backend = LocalFileBackend("media", "/files")
+    backend.save("abc.jpg", io.BytesIO(b"abcdef"))
+    assert backend.get_path("abc.jpg") == str(tmp_path / "media" / "abc.jpg")
+
+
+def test_lru_file_cache_evicts_least_recently_read(tmp_path):
+    cache = LRUFileCache(str(tmp_path), max_bytes=10)
+
+    def fill(content):
+        return lambda fileobj: fileobj.write(content)
+
+    first = cache.get_or_fill("first", fill(b"12345"))
+    cache.get_or_fill("second", fill(b"12345"))
+    assert cache.get_or_fill("first", fill(b"changed")) == first
+
+    cache.get_or_fill("third", fill(b"12345"))
+    assert list(cache.entries) == ["first", "third"]
+    assert cache.total_bytes == 10
+    assert not os.path.exists(tmp_path / "second")
+
+
+def test_lru_file_cache_missing_file(tmp_path):
+    cache = LRUFileCache(str(tmp_path), max_bytes=10)
+    assert cache.get_or_fill("missing", lambda fileobj: False) is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_api_serve_file(local_backend, client):
+    local_backend.save("abc.jpg", io.BytesIO(b"abcdef"))
+
+    response = client.get("/files/abc.jpg")
+    assert response.status_code == 200
+    assert response.data == b"abcdef"
+    assert response.mimetype == "image/jpeg"
+    assert "immutable" in response.headers["Cache-Control"]
+
+    response = client.get("/files/abc.jpg", headers={"Range": "bytes=2-3"})
+    assert response.status_code == 206
+    assert response.data == b"cd"
+
+
+def test_api_serve_file_not_found(local_backend, client):
+    response = client.get("/files/missing.jpg")
+    assert response.status_code == 404
+
+
+def test_lru_file_cache_shared_by_workers(tmp_path):
+    first = LRUFileCache(str(tmp_path), max_bytes=10)
+    second = LRUFileCache(str(tmp_path), max_bytes=10)
+    first.get_or_fill("shared", lambda fileobj: fileobj.write(b"12345"))
+
+    # filled by the first worker, the second one serves it as is
+    path = second.get_or_fill("shared", lambda fileobj: fileobj.write(b"changed"))
+    with open(path, "rb") as fileobj:
+        assert fileobj.read() == b"12345"
+    assert second.total_bytes == 5
+
+    # evicted by the second worker, the first one fills it again
+    second.get_or_fill("other", lambda fileobj: fileobj.write(b"1234567"))
+    assert not os.path.exists(path)
+    assert first.get_or_fill("shared", lambda fileobj: fileobj.write(b"12345")) == path
+    assert os.path.exists(path)
+    assert first.total_bytes == 5
+
+
+def test_lru_file_cache_keeps_fresh_temp_files(tmp_path):
+    fresh = tmp_path / ".upload-fresh"
+    fresh.write_bytes(b"123")
+    stale = tmp_path / ".upload-stale"
+    stale.write_bytes(b"123")
+    os.utime(stale, (0, 0))
+
+    cache = LRUFileCache(str(tmp_path), max_bytes=10)
+    assert fresh.exists()
+    assert not stale.exists()
+    assert cache.total_bytes == 0
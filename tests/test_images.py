@@ -0,0 +1,68 @@
+import io
+
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from api.images import EXIF_ORIENTATION, get_image_metadata, get_perceptual_hash
+
+
+def make_upload(image_format="JPEG", size=(64, 32), orientation=None):
+    buffer = io.BytesIO()
+    image = Image.new("RGB", size, color=(200, 100, 50))
+    exif = Image.Exif()
+    if orientation:
+        exif[EXIF_ORIENTATION] = orientation
+    image.save(buffer, image_format, exif=exif)
+    buffer.seek(0)
+    return FileStorage(buffer, f"test.{image_format.lower()}")
+
+
+def test_get_image_metadata():
+    upload = make_upload(orientation=6)
+    metadata = get_image_metadata(upload)
+
+    # stored 64x32, displayed rotated by 90 degrees
+    assert metadata["width"] == 32
+    assert metadata["height"] == 64
+    assert metadata["mime_type"] == "image/jpeg"
+    assert metadata["orientation"] == 6
+    assert metadata["size"] == len(upload.stream.getvalue())
+    assert upload.stream.tell() == 0
+
+    placeholder = metadata["placeholder"]
+    assert placeholder.startswith("data:image/jpeg;base64,")
+    assert len(metadata["perceptual_hash"]) == 16
+
+
+def test_get_image_metadata_png_without_exif():
+    metadata = get_image_metadata(make_upload("PNG"))
+    assert metadata["mime_type"] == "image/png"
+    assert metadata["orientation"] == 1
+    assert (metadata["width"], metadata["height"]) == (64, 32)
+
+
+def test_get_image_metadata_not_an_image():
+    upload = FileStorage(io.BytesIO(b"abcdef"), "test.jpg")
+    assert get_image_metadata(upload) == {"size": 6, "mime_type": "image/jpeg"}
+
+
+def test_get_image_metadata_decompression_bomb(monkeypatch):
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 10)
+    upload = make_upload("PNG")
+
+    metadata = get_image_metadata(upload)
+    assert metadata == {
+        "size": len(upload.stream.getvalue()),
+        "mime_type": "image/png",
+    }
+    assert upload.stream.tell() == 0
+
+
+def test_get_perceptual_hash():
+    gradient = Image.linear_gradient("L").rotate(90).resize((64, 64))
+    reencoded = gradient.resize((300, 300)).convert("RGB")
+    flipped = gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+
+    gradient_hash = int(get_perceptual_hash(gradient), 16)
+    assert bin(gradient_hash ^ int(get_perceptual_hash(reencoded), 16)).count("1") < 4
+    assert bin(gradient_hash ^ int(get_perceptual_hash(flipped), 16)).count("1") > 16
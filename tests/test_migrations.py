@@ -0,0 +1,148 @@
+import pytest
+from bson.objectid import ObjectId
+
+from api.migrations import MIGRATIONS, Migration, MigrationRunner
+from api.models import MigrationCheckpoint, Photo
+from api.store import CommentStore, MigrationStore, PhotoStore
+
+
+def to_https(photos):
+    return [
+        {"_id": photo["_id"], "URI": photo["URI"].replace("s3://", "https://")}
+        for photo in photos
+    ]
+
+
+def save_photos(photo_store, count):
+    for index in range(count):
+        photo = Photo(
+            {
+                "_id": ObjectId(),
+                "URI": f"s3://photoview/test{index}.png",
+                "user_id": ObjectId(),
+            }
+        )
+        photo_store.save(photo)
+
+
+def test_migration_runner(mongo_db):
+    db = mongo_db()
+    photo_store = PhotoStore(db)
+    save_photos(photo_store, 7)
+
+    migration = Migration("photo-https", PhotoStore, to_https)
+    runner = MigrationRunner(
+        migration, photo_store, MigrationStore(db), workers=2, batch_size=2
+    )
+    assert runner.run() == 7
+
+    photos = photo_store.find({"visible": False})
+    assert all(photo.URI.startswith("https://") for photo in photos)
+
+    checkpoints = MigrationStore(db).get_checkpoints("photo-https")
+    assert all(checkpoint.done for checkpoint in checkpoints)
+    assert sum(checkpoint.processed for checkpoint in checkpoints) == 7
+
+
+def test_migration_runner_resumes(mongo_db):
+    db = mongo_db()
+    photo_store = PhotoStore(db)
+    save_photos(photo_store, 5)
+
+    calls = []
+
+    def failing_transform(photos):
+        calls.append(photos)
+        if len(calls) > 1:
+            raise RuntimeError("interrupted")
+        return to_https(photos)
+
+    migration = Migration("photo-https", PhotoStore, failing_transform)
+    runner = MigrationRunner(
+        migration, photo_store, MigrationStore(db), workers=1, batch_size=2
+    )
+    with pytest.raises(RuntimeError):
+        runner.run()
+
+    migration.transform = to_https
+    assert runner.run() == 3
+
+    photos = photo_store.find({"visible": False})
+    assert all(photo.URI.startswith("https://") for photo in photos)
+
+
+def test_migration_runner_replaces_incomplete_plan(mongo_db):
+    db = mongo_db()
+    photo_store = PhotoStore(db)
+    migration_store = MigrationStore(db)
+    save_photos(photo_store, 5)
+
+    # only the first of two checkpoints was written before a crash
+    migration_store.save(
+        MigrationCheckpoint(
+            {
+                "_id": "photo-https:0000",
+                "migration": "photo-https",
+                "end": ObjectId(),
+                "ranges": 2,
+            }
+        )
+    )
+
+    migration = Migration("photo-https", PhotoStore, to_https)
+    runner = MigrationRunner(
+        migration, photo_store, migration_store, workers=2, batch_size=2
+    )
+    assert runner.run() == 5
+
+    photos = photo_store.find({"visible": False})
+    assert all(photo.URI.startswith("https://") for photo in photos)
+
+
+def test_comment_photo_visible_migration(mongo_db):
+    db = mongo_db()
+    photo_store = PhotoStore(db)
+    comment_store = CommentStore(db)
+
+    photo_ids = []
+    for visible in (True, False):
+        photo = Photo(
+            {
+                "_id": ObjectId(),
+                "URI": "s3://photoview/test.png",
+                "user_id": ObjectId(),
+                "visible": visible,
+            }
+        )
+        photo_ids.append(photo_store.save(photo)._id)
+
+    for photo_id in photo_ids + photo_ids:
+        comment_store.db.insert_one(
+            {
+                "_id": ObjectId(),
+                "photo_id": photo_id,
+                "user_id": ObjectId(),
+                "text": "comment test",
+            }
+        )
+
+    migration = MIGRATIONS["comment-photo-visible"]
+    runner = MigrationRunner(migration, comment_store, MigrationStore(db))
+    assert runner.run() == 4
+
+    for photo_id, visible in zip(photo_ids, (True, False)):
+        comments = comment_store.find({"photo_id": photo_id})
+        assert [comment.photo_visible for comment in comments] == [visible] * 2
+
+
+def test_migration_runner_throttles_on_replication_lag(mongo_db):
+    db = mongo_db()
+    sleeps = []
+    lags = iter([30, 12, 0])
+
+    runner = MigrationRunner(
+        None, PhotoStore(db), MigrationStore(db), max_lag=10, sleep=sleeps.append
+    )
+    runner.replication_lag = lambda: next(lags)
+    runner.throttle()
+    assert sleeps == [30, 12]
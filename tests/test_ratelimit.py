@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+
+from api import config
+from api.ratelimit import ConcurrencyLimiter, MemoryBackend, parse_rate
+from api.store import RateLimitStore
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_parse_rate():
+    assert parse_rate("10/60") == (10, 10 / 60)
+
+
+def test_memory_backend_refills_over_time():
+    clock = Clock()
+    backend = MemoryBackend(clock=clock)
+
+    assert backend.consume("key", 2, 1)[0] is True
+    assert backend.consume("key", 2, 1)[0] is True
+    assert backend.consume("key", 2, 1)[0] is False
+    assert backend.consume("other", 2, 1)[0] is True
+
+    clock.now += 1
+    assert backend.consume("key", 2, 1)[0] is True
+    assert backend.consume("key", 2, 1)[0] is False
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryBackend(clock=Clock(), max_keys=2)
+    backend.consume("first", 2, 1)
+    backend.consume("second", 2, 1)
+    backend.consume("first", 2, 1)
+
+    backend.consume("third", 2, 1)
+    assert list(backend.buckets) == ["first", "third"]
+    assert backend.buckets["first"][0] == 0
+
+
+def test_rate_limit_store_consume(mongo_db):
+    rate_limit_store = RateLimitStore(mongo_db())
+
+    assert rate_limit_store.consume("key", 2, 1 / 3600) == (True, 1)
+    allowed, tokens = rate_limit_store.consume("key", 2, 1 / 3600)
+    assert allowed is True
+    assert tokens < 1
+    assert rate_limit_store.consume("key", 2, 1 / 3600)[0] is False
+    assert rate_limit_store.consume("other", 2, 1 / 3600)[0] is True
+
+    rate_limit_store.db.update_one(
+        {"_id": "key"},
+        {"$set": {"updated_at": datetime.utcnow() - timedelta(hours=1)}},
+    )
+    assert rate_limit_store.consume("key", 2, 1 / 3600)[0] is True
+
+
+def test_concurrency_limiter_sheds_load(app):
+    limiter = ConcurrencyLimiter(1)
+    calls = []
+
+    @limiter.limit
+    def view():
+        calls.append(nested())
+        return "ok"
+
+    @limiter.limit
+    def nested():
+        return "nested"
+
+    with app.test_request_context():
+        assert view() == "ok"
+        response, status_code = calls[0]
+    assert status_code == 503
+
+
+def test_api_signin_rate_limited(client):
+    capacity, _ = parse_rate(config.rate_limit_auth)
+    data = {"email": "nobody@test.com", "password": "password"}
+    for _ in range(capacity):
+        response = client.post("/signin", json=data)
+        assert response.status_code == 401
+
+    response = client.post("/signin", json=data)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
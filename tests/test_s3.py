@@ -0,0 +1,34 @@
+import hashlib
+import io
+from unittest import mock
+
+from werkzeug.datastructures import FileStorage
+
+from api.files import LRUFileCache
+from api.s3 import S3FileBackend, get_content_hash, get_s3_key
+
+
+def test_get_content_hash():
+    file = FileStorage(io.BytesIO(b"abcdef"), "test.jpg")
+    assert get_content_hash(file) == hashlib.sha256(b"abcdef").hexdigest()
+    assert file.read() == b"abcdef"
+
+
+def test_get_s3_key_is_content_addressed():
+    assert get_s3_key("Photo.JPG", "abc") == "abc.jpg"
+    assert get_s3_key("other.jpg", "abc") == get_s3_key("photo.jpg", "abc")
+
+
+@mock.patch("api.s3.get_s3_bucket")
+def test_s3_file_backend_reads_through_cache(get_s3_bucket_mocked, tmp_path):
+    bucket = get_s3_bucket_mocked.return_value
+    bucket.download_fileobj.side_effect = lambda key, fileobj: fileobj.write(b"abcdef")
+    backend = S3FileBackend(LRUFileCache(str(tmp_path), max_bytes=100), "/files")
+
+    assert backend.save("abc.jpg", io.BytesIO(b"abcdef")) == "/files/abc.jpg"
+
+    path = backend.get_path("abc.jpg")
+    with open(path, "rb") as fileobj:
+        assert fileobj.read() == b"abcdef"
+    assert backend.get_path("abc.jpg") == path
+    bucket.download_fileobj.assert_called_once()
@@ -0,0 +1,98 @@
+import random
+import time
+
+from bson.objectid import ObjectId
+
+from api.models import Photo
+from api.similarity import MultiIndexHash, PhotoSimilarityIndex, hamming_distance
+from api.store import PhotoStore
+
+
+def flip_bits(value, count, rng):
+    for bit in rng.sample(range(64), count):
+        value ^= 1 << bit
+    return value
+
+
+def test_multi_index_hash_matches_linear_scan():
+    rng = random.Random(42)
+    index = MultiIndexHash()
+    hashes = {str(key): rng.getrandbits(64) for key in range(2000)}
+    for key, value in hashes.items():
+        index.add(key, value)
+
+    query = flip_bits(hashes["7"], 5, rng)
+    for max_distance in (0, 8, 20):
+        expected = sorted(
+            (hamming_distance(query, value), key)
+            for key, value in hashes.items()
+            if hamming_distance(query, value) <= max_distance
+        )
+        assert index.search(query, max_distance) == expected
+    assert (5, "7") in index.search(query, 8)
+
+
+def test_multi_index_hash_remove():
+    index = MultiIndexHash()
+    index.add("first", 0xFF)
+    index.add("first", 0xF0)
+    assert index.search(0xF0, 0) == [(0, "first")]
+
+    index.add("copy", 0xF0)
+    index.remove("first")
+    assert index.search(0xF0, 8) == [(0, "copy")]
+
+    index.remove("copy")
+    assert index.search(0xF0, 8) == []
+    assert len(index) == 0
+    assert all(not table for table in index.tables)
+
+
+def test_multi_index_hash_latency():
+    rng = random.Random(42)
+    index = MultiIndexHash()
+    for key in range(100_000):
+        index.add(key, rng.getrandbits(64))
+    assert index.chunks == 3
+
+    queries = [rng.getrandbits(64) for _ in range(200)]
+    started_at = time.perf_counter()
+    for query in queries:
+        index.search(query, 8)
+    assert (time.perf_counter() - started_at) / len(queries) < 0.001
+
+
+def test_photo_similarity_index(mongo_db):
+    photo_store = PhotoStore(mongo_db())
+    perceptual_hashes = ("ffff0000ffff0000", "ffff0000ffff0001", "0000ffff0000ffff")
+    photos = []
+    for perceptual_hash in perceptual_hashes:
+        photo = Photo(
+            {
+                "_id": ObjectId(),
+                "URI": f"s3://photoview/{perceptual_hash}.png",
+                "user_id": ObjectId(),
+                "perceptual_hash": perceptual_hash,
+            }
+        )
+        photos.append(photo_store.save(photo))
+
+    similarity_index = PhotoSimilarityIndex(photo_store, sync_interval=0)
+    assert similarity_index.similar("ffff0000ffff0000", exclude=str(photos[0]._id)) == [
+        {"id": str(photos[1]._id), "distance": 1}
+    ]
+
+    photo = Photo(
+        {
+            "_id": ObjectId(),
+            "URI": "s3://photoview/copy.png",
+            "user_id": ObjectId(),
+            "perceptual_hash": "ffff0000ffff0000",
+        }
+    )
+    photo_store.save(photo)
+    results = similarity_index.similar("ffff0000ffff0000", max_distance=0)
+    assert {result["id"] for result in results} == {
+        str(photos[0]._id),
+        str(photo._id),
+    }
@@ -0,0 +1,35 @@
+import os
+import re
+import subprocess
+import sys
+
+IMPORT_TIME_BUDGET_US = 1_500_000
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_app(code=""):
+    return subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import api.app; {code}"],
+        cwd=ROOT_PATH,
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+
+
+def test_import_does_not_build_clients():
+    import_app(
+        "import sys; from api import s3, store; "
+        "assert store.get_mongo_client.value is None; "
+        "assert store.get_stores.value is None; "
+        "assert s3.get_s3_bucket.value is None; "
+        "assert 'boto3' not in sys.modules"
+    )
+
+
+def test_import_time_budget():
+    result = import_app()
+    match = re.search(r"\|\s*(\d+)\s*\|\s*api\.app$", result.stderr, re.MULTILINE)
+    assert match is not None
+    assert int(match.group(1)) < IMPORT_TIME_BUDGET_US
@@ -1,7 +1,18 @@
+from datetime import datetime
+
+import pytest
 from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError
 
-from api.models import Photo
-from api.store import PhotoStore
+from api.models import Comment, Like, Photo
+from api.store import (
+    CommentStore,
+    LikeBucketStore,
+    LikeStore,
+    PhotoStore,
+    RateLimitStore,
+)
 
 
 def test_photo_store_get_visible_photos(mongo_db):
@@ -48,3 +59,244 @@ def test_photo_store_authorized(mongo_db):
     photo_store.authorized(photo._id)
     photo = photo_store.get_by_id(photo._id)
     assert photo.visible is True
+
+
+def test_photo_store_get_or_save(mongo_db):
+    photo_store = PhotoStore(mongo_db())
+    photo = Photo(
+        {
+            "_id": ObjectId(),
+            "URI": "s3://photoview/abc.png",
+            "user_id": ObjectId(),
+            "content_hash": "abc",
+        }
+    )
+    saved_photo, created = photo_store.get_or_save(photo)
+    assert created is True
+
+    duplicate = Photo(
+        {
+            "_id": ObjectId(),
+            "URI": "s3://photoview/abc.png",
+            "user_id": ObjectId(),
+            "content_hash": "abc",
+        }
+    )
+    photo, created = photo_store.get_or_save(duplicate)
+    assert created is False
+    assert photo._id == saved_photo._id
+
+
+def test_photo_store_get_trending_photos(mongo_db):
+    db = mongo_db()
+    photo_store = PhotoStore(db)
+    like_store = LikeStore(db)
+    comment_store = CommentStore(db)
+
+    photos = []
+    for index in range(3):
+        photo = Photo(
+            {
+                "_id": ObjectId(),
+                "URI": f"s3://photoview/test{index}.png",
+                "user_id": ObjectId(),
+                "visible": index != 2,
+            }
+        )
+        photos.append(photo_store.save(photo))
+
+    for photo, likes in zip(photos, (1, 5, 6)):
+        for _ in range(likes):
+            like_store.save(
+                Like({"_id": ObjectId(), "photo_id": photo._id, "user_id": ObjectId()})
+            )
+    comment_store.save(
+        Comment(
+            {
+                "_id": ObjectId(),
+                "photo_id": photos[0]._id,
+                "user_id": ObjectId(),
+                "text": "comment test",
+            }
+        )
+    )
+
+    photo_store.trending_store.refresh(like_store, comment_store)
+
+    trending, next_cursor = photo_store.get_trending_photos(per_page=1)
+    assert [photo["id"] for photo in trending] == [str(photos[1]._id)]
+
+    trending, next_cursor = photo_store.get_trending_photos(
+        after=next_cursor, per_page=1
+    )
+    assert [photo["id"] for photo in trending] == [str(photos[0]._id)]
+
+    trending, next_cursor = photo_store.get_trending_photos(
+        after=next_cursor, per_page=1
+    )
+    assert trending == []
+    assert next_cursor is None
+
+
+def test_photo_store_get_user_photos(mongo_db):
+    photo_store = PhotoStore(mongo_db())
+    user_id = ObjectId()
+
+    # inserted directly, save would overwrite created_at
+    photos = [
+        {
+            "_id": ObjectId(),
+            "URI": f"s3://photoview/test{index}.png",
+            "user_id": user_id,
+            "visible": index != 1,
+            "created_at": datetime(2021, 1, 2 if index == 4 else 1),
+        }
+        for index in range(5)
+    ]
+    photos.append(
+        {
+            "_id": ObjectId(),
+            "URI": "s3://photoview/other.png",
+            "user_id": ObjectId(),
+            "visible": True,
+            "created_at": datetime(2021, 1, 1),
+        }
+    )
+    photo_store.db.insert_many(photos)
+    photo_ids = [str(photo["_id"]) for photo in photos]
+
+    def get_pages(include_hidden):
+        pages, next_cursor = [], None
+        while True:
+            user_photos, next_cursor = photo_store.get_user_photos(
+                user_id, include_hidden=include_hidden, after=next_cursor, per_page=2
+            )
+            pages.append(user_photos)
+            if next_cursor is None:
+                return pages
+
+    # pages break between photos uploaded at the same time
+    pages = get_pages(include_hidden=True)
+    assert [[photo["id"] for photo in page] for page in pages] == [
+        [photo_ids[4], photo_ids[3]],
+        [photo_ids[2], photo_ids[1]],
+        [photo_ids[0]],
+    ]
+    assert [photo["visible"] for photo in pages[1]] == [True, False]
+
+    pages = get_pages(include_hidden=False)
+    assert [[photo["id"] for photo in page] for page in pages] == [
+        [photo_ids[4], photo_ids[3]],
+        [photo_ids[2], photo_ids[0]],
+        [],
+    ]
+    assert "visible" not in pages[0][0]
+
+    explain = (
+        photo_store.db.find(
+            {"user_id": user_id, "visible": True},
+            {"_id": True, "URI": True, "created_at": True},
+        )
+        .sort([("created_at", DESCENDING), ("_id", DESCENDING)])
+        .explain()
+    )
+    assert explain["executionStats"]["totalDocsExamined"] == 0
+
+
+def test_like_bucket_store_save(mongo_db):
+    like_bucket_store = LikeBucketStore(mongo_db())
+    like_bucket_store.bucket_size = 2
+    photo_id = ObjectId()
+
+    likes = []
+    for _ in range(3):
+        like = Like({"_id": ObjectId(), "photo_id": photo_id, "user_id": ObjectId()})
+        likes.append(like_bucket_store.save(like))
+
+    duplicate = Like(
+        {"_id": ObjectId(), "photo_id": photo_id, "user_id": likes[0].user_id}
+    )
+    assert like_bucket_store.save(duplicate)._id == likes[0]._id
+    # concurrent duplicates that got past get_like are rejected by the index
+    for like in (likes[0], likes[2]):
+        duplicate = Like(
+            {"_id": ObjectId(), "photo_id": photo_id, "user_id": like.user_id}
+        )
+        with pytest.raises(DuplicateKeyError):
+            like_bucket_store.push(duplicate)
+
+    assert like_bucket_store.count_by_photo(photo_id) == 3
+    assert like_bucket_store.count_by_photo(ObjectId()) == 0
+    assert like_bucket_store.db.count_documents({"photo_id": photo_id}) == 2
+
+    like = like_bucket_store.get_like(photo_id, likes[2].user_id)
+    assert like._id == likes[2]._id
+    assert like.photo_id == photo_id
+
+
+def test_like_bucket_store_migrate_from(mongo_db):
+    db = mongo_db()
+    like_store = LikeStore(db)
+    like_bucket_store = LikeBucketStore(db)
+    like_bucket_store.bucket_size = 2
+
+    photo_id, user_id = ObjectId(), ObjectId()
+    for liker_id in (user_id, user_id, ObjectId(), ObjectId()):
+        like_store.save(
+            Like({"_id": ObjectId(), "photo_id": photo_id, "user_id": liker_id})
+        )
+
+    assert like_bucket_store.migrate_from(like_store) == 3
+    assert like_bucket_store.migrate_from(like_store) == 0
+    assert like_bucket_store.count_by_photo(photo_id) == 3
+    assert like_store.count_by_photo(photo_id) == 4
+    assert like_bucket_store.get_like(photo_id, user_id) is not None
+
+
+def test_comment_store_search(mongo_db):
+    comment_store = CommentStore(mongo_db())
+    photo_id = ObjectId()
+
+    texts = ("spam spam spam", "spam under a nice beach view", "nice photo")
+    for text in texts:
+        comment_store.save(
+            Comment(
+                {
+                    "_id": ObjectId(),
+                    "photo_id": photo_id,
+                    "user_id": ObjectId(),
+                    "text": text,
+                }
+            )
+        )
+
+    comments, next_cursor = comment_store.search("spam", per_page=1)
+    assert [comment["text"] for comment in comments] == ["spam spam spam"]
+
+    comments, next_cursor = comment_store.search("spam", after=next_cursor, per_page=1)
+    assert [comment["text"] for comment in comments] == ["spam under a nice beach view"]
+
+    comments, next_cursor = comment_store.search("spam", after=next_cursor, per_page=1)
+    assert comments == []
+    assert next_cursor is None
+
+    comments, _ = comment_store.search("spam", photo_id=ObjectId())
+    assert comments == []
+
+    comments, _ = comment_store.search("spam", visible=False)
+    assert len(comments) == 2
+
+    comment_store.set_photo_visible(photo_id)
+    comments, _ = comment_store.search("spam", visible=False)
+    assert comments == []
+
+
+def test_ensure_indexes_updates_ttl(mongo_db):
+    class ShortLivedRateLimitStore(RateLimitStore):
+        indexes = (IndexModel([("updated_at", ASCENDING)], expireAfterSeconds=60),)
+
+    db = mongo_db()
+    ShortLivedRateLimitStore(db).ensure_indexes()
+
+    indexes = RateLimitStore(db).db.index_information()
+    assert indexes["updated_at_1"]["expireAfterSeconds"] == 60